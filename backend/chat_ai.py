@@ -1,34 +1,44 @@
+import math
 import random
 import time
 import re
 import sys
 import signal
+import os
 import logging
-from openai import OpenAI
+from model_pool import EndpointPool, NoEndpointAvailable, COOLDOWN
 
-client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
+# Несколько OpenAI-совместимых серверов через запятую: LM_ENDPOINTS=http://a:1234/v1,http://b:1234/v1
+MODEL_ENDPOINTS = [u.strip() for u in os.environ.get("LM_ENDPOINTS", "http://localhost:1234/v1").split(",") if u.strip()]
+model_pool = EndpointPool(MODEL_ENDPOINTS, api_key="lm-studio")
 MODEL_NAME = "lmstudio-community/qwen2.5-14b-instruct-1m"
 
 # ---- Параметры симуляции ----
 SLEEP_TIME = 3
-CONTEXT_LIMIT = 6
 MAX_TOKENS = 160
 CHAT_HISTORY_LIMIT = 400
 MEMORY_MAX = 80
-MEMORY_SUMMARY_LEN = 3
 INITIAL_TOPIC = "информатика и IT"
 ALLOW_MILD_PROFANITY = True
 
+# ---- Бюджет контекста (в токенах) ----
+CHARS_PER_TOKEN = 3.0          # грубая оценка для кириллицы без токенизатора
+CONTEXT_WINDOW = 24            # сколько последних сообщений рассматривать как кандидатов
+CONTEXT_TOKEN_BUDGET = 360
+MEMORY_TOKEN_BUDGET = 90
+SUMMARY_TOKEN_BUDGET = 120
+SUMMARY_PART_CHARS = 120
+RECENCY_DECAY = 0.85
+
 # ---- Агенты ----
-agents = {
-    "Даша": {"role": "флористка, тёплые метафоры с цветами, 1–2 предложения.", "memory": []},
-    "Кирилл": {"role": "шеф-повар, сарказм, кулинарные аналогии, 1–2 предложения.", "memory": []},
-    "Ника": {"role": "спортсменка, энергичная, короткие фразы, эмодзи уместны.", "memory": []},
-    "Дмитрий": {"role": "аспирант, научные метафоры, философичность, 1–2 предложения.", "memory": []}
+AGENT_ROLES = {
+    "Даша": "флористка, тёплые метафоры с цветами, 1–2 предложения.",
+    "Кирилл": "шеф-повар, сарказм, кулинарные аналогии, 1–2 предложения.",
+    "Ника": "спортсменка, энергичная, короткие фразы, эмодзи уместны.",
+    "Дмитрий": "аспирант, научные метафоры, философичность, 1–2 предложения."
 }
-
-relationships = {a: {b: 0.5 for b in agents if b != a} for a in agents}
-relationship_history = []
+STARTER = "Даша"
+STARTER_TEXT = "Всем привет! У меня пионы — давайте обсудим, как цветы влияют на творчество."
 
 NOISE_PATTERNS = [
     r"\bim_start\b",
@@ -110,35 +120,53 @@ def jaccard_similarity(a: str, b: str) -> float:
         return 0.0
     return len(wa.intersection(wb)) / max(1, len(wa.union(wb)))
 
-def memory_summary(agent_name: str) -> str:
-    mem = agents[agent_name]["memory"]
-    if not mem:
-        return ""
-    return " | ".join(mem[-MEMORY_SUMMARY_LEN:])
-
-def build_prompt(agent_name: str, last_speaker: str, last_text: str, chat_history: list, topic: str) -> str:
-    role = agents[agent_name]["role"]
-    mem = memory_summary(agent_name)
-    context = "\n".join([f"[{m['name']}]: {m['text']}" for m in chat_history[-CONTEXT_LIMIT:]])
-    instr = (
-        f"{role}\nТема: «{topic}». Не сворачивать.\n"
-        f"Правила: 1) Без markdown. 2) Не цитируй дословно. 3) Обратись к {last_speaker} по имени. 4) 1–2 предложения.\n"
-    )
-    if ALLOW_MILD_PROFANITY:
-        instr += "Допускается мягкая грубость в адрес идеи.\n"
-    prompt = (
-        instr +
-        ("\nПамять: " + mem + "\n" if mem else "\n") +
-        "Контекст:\n" + (context if context else "—") + "\n\n" +
-        f"{last_speaker}: \"{last_text}\"\n\nОтвет {agent_name.strip()}: "
-    )
-    return prompt
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+def format_message(m: dict) -> str:
+    return f"[{m['name']}]: {m['text']}"
+
+def cached_tokens(entry: dict, rendered: str) -> int:
+    # Считаем один раз и храним рядом с записью истории/памяти
+    tokens = entry.get("tokens")
+    if tokens is None:
+        tokens = entry["tokens"] = count_tokens(rendered)
+    return tokens
+
+def make_message(name: str, text: str) -> dict:
+    m = {"name": name, "text": text}
+    cached_tokens(m, format_message(m))
+    return m
 
+def pack_by_budget(scored: list, budget: int) -> list:
+    """scored: [(score, index, tokens)]; жадно берём от самых релевантных, пока влезает"""
+    chosen = []
+    left = budget
+    for score, index, tokens in sorted(scored, key=lambda x: (-x[0], -x[1])):
+        if tokens <= left:
+            chosen.append(index)
+            left -= tokens
+    return sorted(chosen)
+
+def pack_history(agent_name: str, last_text: str, chat_history: list, budget: int = CONTEXT_TOKEN_BUDGET) -> list:
+    # Последняя реплика цитируется в промпте отдельно, в контекст её не дублируем
+    candidates = chat_history[-(CONTEXT_WINDOW + 1):-1]
+    scored = []
+    for i, m in enumerate(candidates):
+        age = len(candidates) - 1 - i
+        score = RECENCY_DECAY ** age + jaccard_similarity(m["text"], last_text)
+        if agent_name in m["text"]:
+            score += 0.3
+        scored.append((score, i, cached_tokens(m, format_message(m))))
+    return [candidates[i] for i in pack_by_budget(scored, budget)]
 
 def call_model(prompt: str) -> str:
+    """Ответ модели; NoEndpointAvailable пробрасывается - ход не засчитывается."""
     try:
         messages = [{"role": "user", "content": prompt}]
-        resp = client.chat.completions.create(
+        resp = model_pool.chat_completion(
             model=MODEL_NAME,
             messages=messages,
             temperature=0.65,
@@ -160,113 +188,218 @@ def call_model(prompt: str) -> str:
         if text is None:
             text = getattr(resp, "text", None) or "..."
         return str(text)
+    except NoEndpointAvailable:
+        raise
     except Exception as e:
         logging.exception("Ошибка модели при вызове API")
         return "..."
 
 
-def ensure_direct_reply(agent_name: str, raw: str, last_speaker: str, last_text: str, topic: str,
-                        recent_msgs: list) -> str:
-    cleaned = clean_and_trim(raw, agent_name)
-    tokenized = re.split(r"\W+", cleaned)
-    if last_speaker not in tokenized:
-        strict = f"СРОЧНО: Обратись к {last_speaker} по имени. Без цитат. Коротко."
-        raw2 = call_model(build_prompt(agent_name, last_speaker, last_text, recent_msgs, topic) + "\n\n" + strict)
-        cleaned = clean_and_trim(raw2, agent_name)
-    sims = [jaccard_similarity(cleaned, m["text"]) for m in recent_msgs[-6:]] if recent_msgs else []
-    if sims and max(sims) > 0.6:
-        cleaned = f"{last_speaker}, идея интересна, но давай копнём глубже."
-    if len(cleaned) <= 5:
-        return f"{last_speaker}, поясни мысль конкретнее."
-    return cleaned
-
-def remember(agent_name: str, note: str):
-    n = note.strip()
-    if not n:
-        return
-    mem = agents[agent_name]["memory"]
-    if mem and mem[-1] == n:
-        return
-    mem.append(n)
-    if len(mem) > MEMORY_MAX:
-        mem.pop(0)
-
-def update_relationships(speaker: str, target: str, text: str):
-    t = text.lower()
-    delta = 0.0
-    if any(w in t for w in ["не соглас", "туп", "идиот", "дурак"]):
-        delta -= 0.06
-    if any(w in t for w in ["прав", "соглас", "молодец", "красиво", "хорошо"]):
-        delta += 0.04
-    newv = max(0.0, min(1.0, relationships[speaker][target] + delta))
-    relationships[speaker][target] = newv
-    relationships[target][speaker] = newv
-
-def save_graph():
-    try:
-        import matplotlib.pyplot as plt
-        if len(relationship_history) < 2:
+class World:
+    """
+    Одна комната-симуляция: агенты, их память, отношения и история чата.
+    Всё состояние живёт в экземпляре, поэтому в одном процессе
+    может идти сколько угодно независимых разговоров.
+    """
+
+    def __init__(self, world_id: str = "main", topic: str = INITIAL_TOPIC, roles: dict = None, seed=None):
+        self.world_id = world_id
+        self.topic = topic
+        self.rng = random.Random(seed)
+        roles = roles or AGENT_ROLES
+        self.agents = {name: {"role": role, "memory": []} for name, role in roles.items()}
+        self.relationships = {a: {b: 0.5 for b in self.agents if b != a} for a in self.agents}
+        self.relationship_history = []
+        # Свернутая история: то, что выпало из окна CONTEXT_WINDOW
+        self.rolling_summary = {"parts": [], "tokens": 0, "text": ""}
+        self.chat_history = []
+        self.last_speakers = []
+        self.turn = 0
+
+    def memory_summary(self, agent_name: str, last_text: str = "", budget: int = MEMORY_TOKEN_BUDGET) -> str:
+        mem = self.agents[agent_name]["memory"]
+        if not mem:
+            return ""
+        scored = []
+        for i, note in enumerate(mem):
+            age = len(mem) - 1 - i
+            score = RECENCY_DECAY ** age + jaccard_similarity(note["text"], last_text)
+            scored.append((score, i, cached_tokens(note, note["text"])))
+        return " | ".join(mem[i]["text"] for i in pack_by_budget(scored, budget))
+
+    def update_rolling_summary(self) -> str:
+        """Дописать в свёрнутую историю сообщения, выпавшие из окна; результат кэшируется"""
+        summary = self.rolling_summary
+        older = self.chat_history[:-(CONTEXT_WINDOW + 1)]
+        fresh = []
+        for m in reversed(older):
+            if m.get("summarized"):
+                break
+            fresh.append(m)
+        if not fresh:
+            return summary["text"]
+        for m in reversed(fresh):
+            first = re.split(r'(?<=[.!?])\s+', m["text"], maxsplit=1)[0]
+            if len(first) > SUMMARY_PART_CHARS:
+                first = first[:SUMMARY_PART_CHARS - 3].rstrip() + "..."
+            part = f"{m['name']}: {first}"
+            tokens = count_tokens(part)
+            summary["parts"].append((part, tokens))
+            summary["tokens"] += tokens
+            m["summarized"] = True
+        while summary["tokens"] > SUMMARY_TOKEN_BUDGET and summary["parts"]:
+            _, tokens = summary["parts"].pop(0)
+            summary["tokens"] -= tokens
+        summary["text"] = " ".join(part for part, _ in summary["parts"])
+        return summary["text"]
+
+    def build_prompt(self, agent_name: str, last_speaker: str, last_text: str) -> str:
+        role = self.agents[agent_name]["role"]
+        mem = self.memory_summary(agent_name, last_text)
+        summary = self.update_rolling_summary()
+        context = "\n".join(format_message(m) for m in pack_history(agent_name, last_text, self.chat_history))
+        instr = (
+            f"{role}\nТема: «{self.topic}». Не сворачивать.\n"
+            f"Правила: 1) Без markdown. 2) Не цитируй дословно. 3) Обратись к {last_speaker} по имени. 4) 1–2 предложения.\n"
+        )
+        if ALLOW_MILD_PROFANITY:
+            instr += "Допускается мягкая грубость в адрес идеи.\n"
+        prompt = (
+            instr +
+            ("\nПамять: " + mem + "\n" if mem else "\n") +
+            ("Ранее в разговоре: " + summary + "\n" if summary else "") +
+            "Контекст:\n" + (context if context else "—") + "\n\n" +
+            f"{last_speaker}: \"{last_text}\"\n\nОтвет {agent_name.strip()}: "
+        )
+        return prompt
+
+    def ensure_direct_reply(self, agent_name: str, raw: str, last_speaker: str, last_text: str) -> str:
+        cleaned = clean_and_trim(raw, agent_name)
+        tokenized = re.split(r"\W+", cleaned)
+        if last_speaker not in tokenized:
+            strict = f"СРОЧНО: Обратись к {last_speaker} по имени. Без цитат. Коротко."
+            raw2 = call_model(self.build_prompt(agent_name, last_speaker, last_text) + "\n\n" + strict)
+            cleaned = clean_and_trim(raw2, agent_name)
+        recent_msgs = self.chat_history
+        sims = [jaccard_similarity(cleaned, m["text"]) for m in recent_msgs[-6:]] if recent_msgs else []
+        if sims and max(sims) > 0.6:
+            cleaned = f"{last_speaker}, идея интересна, но давай копнём глубже."
+        if len(cleaned) <= 5:
+            return f"{last_speaker}, поясни мысль конкретнее."
+        return cleaned
+
+    def remember(self, agent_name: str, note: str):
+        n = note.strip()
+        if not n:
+            return
+        mem = self.agents[agent_name]["memory"]
+        if mem and mem[-1]["text"] == n:
             return
-        plt.figure(figsize=(10, 6))
-        pairs = [(a, b) for a in sorted(relationships) for b in sorted(relationships[a]) if a < b]
-        colors = ['blue', 'orange', 'green', 'red', 'purple', 'brown', 'pink', 'gray']
-        for i, (a, b) in enumerate(pairs):
-            values = [snap.get(a, {}).get(b, 0.5) for snap in relationship_history]
-            plt.plot(values, label=f"{a}-{b}", color=colors[i % len(colors)], linewidth=2)
-        plt.ylim(0, 1)
-        plt.title("Динамика взаимоотношений")
-        plt.legend(fontsize=8)
-        plt.grid(True, alpha=0.25)
-        plt.savefig("relationships.png", dpi=150, bbox_inches='tight')
-        plt.close()
-    except Exception:
-        logging.debug("Не удалось сохранить график.", exc_info=True)
-
-def get_response_for(agent_name: str, chat_history: list, topic: str) -> str:
-    last = chat_history[-1] if chat_history else {"name": "Никто", "text": ""}
-    prompt = build_prompt(agent_name, last["name"], last["text"], chat_history, topic)
-    raw = call_model(prompt)
-    return ensure_direct_reply(agent_name, raw, last["name"], last["text"], topic, chat_history)
+        mem.append({"text": n, "tokens": count_tokens(n)})
+        if len(mem) > MEMORY_MAX:
+            mem.pop(0)
+
+    def update_relationships(self, speaker: str, target: str, text: str):
+        t = text.lower()
+        delta = 0.0
+        if any(w in t for w in ["не соглас", "туп", "идиот", "дурак"]):
+            delta -= 0.06
+        if any(w in t for w in ["прав", "соглас", "молодец", "красиво", "хорошо"]):
+            delta += 0.04
+        newv = max(0.0, min(1.0, self.relationships[speaker][target] + delta))
+        self.relationships[speaker][target] = newv
+        self.relationships[target][speaker] = newv
+
+    def snapshot_relationships(self) -> dict:
+        snap = {k: dict(v) for k, v in self.relationships.items()}
+        self.relationship_history.append(snap)
+        return snap
+
+    def save_graph(self, path: str = "relationships.png"):
+        try:
+            import matplotlib.pyplot as plt
+            if len(self.relationship_history) < 2:
+                return
+            plt.figure(figsize=(10, 6))
+            pairs = [(a, b) for a in sorted(self.relationships) for b in sorted(self.relationships[a]) if a < b]
+            colors = ['blue', 'orange', 'green', 'red', 'purple', 'brown', 'pink', 'gray']
+            for i, (a, b) in enumerate(pairs):
+                values = [snap.get(a, {}).get(b, 0.5) for snap in self.relationship_history]
+                plt.plot(values, label=f"{a}-{b}", color=colors[i % len(colors)], linewidth=2)
+            plt.ylim(0, 1)
+            plt.title("Динамика взаимоотношений")
+            plt.legend(fontsize=8)
+            plt.grid(True, alpha=0.25)
+            plt.savefig(path, dpi=150, bbox_inches='tight')
+            plt.close()
+        except Exception:
+            logging.debug("Не удалось сохранить график.", exc_info=True)
+
+    def get_response_for(self, agent_name: str) -> str:
+        last = self.chat_history[-1] if self.chat_history else {"name": "Никто", "text": ""}
+        prompt = self.build_prompt(agent_name, last["name"], last["text"])
+        raw = call_model(prompt)
+        return self.ensure_direct_reply(agent_name, raw, last["name"], last["text"])
+
+    def start(self, starter: str = STARTER, starter_text: str = STARTER_TEXT) -> dict:
+        m = make_message(starter, starter_text)
+        self.chat_history.append(m)
+        self.remember(starter, starter_text)
+        self.last_speakers = [starter]
+        return m
+
+    def step(self) -> dict:
+        """
+        Один ход: выбрать говорящего, получить ответ модели, обновить память и отношения.
+        Если ни один сервер модели не ответил (NoEndpointAvailable), состояние не меняется.
+        """
+        if not self.chat_history:
+            return self.start()
+        available = [n for n in self.agents if n not in self.last_speakers[-2:]]
+        if not available:
+            available = [n for n in self.agents if n != self.last_speakers[-1]]
+        speaker = self.rng.choice(available)
+        response = self.get_response_for(speaker)
+        if len(response) < 5:
+            response = f"{self.chat_history[-1]['name']}, поясни конкретнее."
+        m = make_message(speaker, response)
+        self.chat_history.append(m)
+        self.remember(speaker, f"{speaker}: {response}")
+        if len(self.chat_history) > CHAT_HISTORY_LIMIT:
+            removed = self.chat_history.pop(0)
+            for a in self.agents:
+                self.remember(a, f"Ранее: {removed['name']}: {removed['text']}")
+        target = self.last_speakers[-1] if self.last_speakers else self.rng.choice([n for n in self.agents if n != speaker])
+        self.update_relationships(speaker, target, response)
+        self.last_speakers.append(speaker)
+        if len(self.last_speakers) > 3:
+            self.last_speakers.pop(0)
+        self.turn += 1
+        return m
+
 
 def simulate_dialog():
-    topic = INITIAL_TOPIC
-    chat_history = []
-    starter = "Даша"
-    starter_text = "Всем привет! У меня пионы — давайте обсудим, как цветы влияют на творчество."
-    print(f"[{starter}]: {starter_text}")
-    chat_history.append({"name": starter, "text": starter_text})
-    remember(starter, starter_text)
-    last_speakers = [starter]
-    turn = 0
+    world = World()
+    first = world.start()
+    print(f"[{first['name']}]: {first['text']}")
     try:
         while True:
             time.sleep(SLEEP_TIME)
-            available = [n for n in agents if n not in last_speakers[-2:]]
-            if not available:
-                available = [n for n in agents if n != last_speakers[-1]]
-            speaker = random.choice(available)
-            response = get_response_for(speaker, chat_history, topic)
-            if len(response) < 5:
-                response = f"{chat_history[-1]['name']}, поясни конкретнее."
-            print(f"[{speaker}]: {response}")
-            chat_history.append({"name": speaker, "text": response})
-            remember(speaker, f"{speaker}: {response}")
-            if len(chat_history) > CHAT_HISTORY_LIMIT:
-                removed = chat_history.pop(0)
-                for a in agents:
-                    remember(a, f"Ранее: {removed['name']}: {removed['text']}")
-            target = last_speakers[-1] if last_speakers else random.choice([n for n in agents if n != speaker])
-            update_relationships(speaker, target, response)
-            last_speakers.append(speaker)
-            if len(last_speakers) > 3:
-                last_speakers.pop(0)
-            turn += 1
-            if turn % 10 == 0:
-                relationship_history.append({k: dict(v) for k, v in relationships.items()})
-                save_graph()
+            try:
+                m = world.step()
+            except NoEndpointAvailable:
+                logging.warning("Серверы модели недоступны, ждём %.0f с", COOLDOWN)
+                time.sleep(COOLDOWN)
+                continue
+            print(f"[{m['name']}]: {m['text']}")
+            if world.turn % 10 == 0:
+                world.snapshot_relationships()
+                world.save_graph()
     except KeyboardInterrupt:
-        relationship_history.append({k: dict(v) for k, v in relationships.items()})
-        save_graph()
+        world.snapshot_relationships()
+        world.save_graph()
+        logging.info("Серверы модели: %s", model_pool.stats())
+        model_pool.close()
         print("\nОстановлено пользователем.")
         sys.exit(0)
 
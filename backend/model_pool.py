@@ -0,0 +1,186 @@
+import time
+import logging
+import threading
+
+import httpx
+import openai
+from openai import OpenAI
+
+# ---- Параметры пула ----
+REQUEST_TIMEOUT = 30.0          # секунд на запрос к одному серверу
+CONNECT_TIMEOUT = 3.0
+MAX_CONNECTIONS = 16            # на один сервер; больше запросов в полёте acquire не выдаёт
+FAILURE_THRESHOLD = 3           # подряд ошибок до размыкания
+COOLDOWN = 15.0                 # секунд до пробного запроса после размыкания
+LATENCY_ALPHA = 0.2             # вес нового замера в EWMA задержки
+
+
+class NoEndpointAvailable(RuntimeError):
+    pass
+
+
+def is_pool_timeout(error: Exception) -> bool:
+    """Таймаут ожидания свободного соединения в нашем же пуле httpx - сервер тут ни при чём."""
+    return isinstance(error, openai.APITimeoutError) and isinstance(error.__cause__, httpx.PoolTimeout)
+
+
+def is_server_failure(error: Exception) -> bool:
+    """Сбой сервера, а не запроса: нет соединения, таймаут (APITimeoutError) или 5xx."""
+    if is_pool_timeout(error):
+        return False
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class Endpoint:
+    """Один OpenAI-совместимый сервер: постоянный клиент с пулом соединений и его статистика."""
+
+    def __init__(self, base_url: str, api_key: str = "lm-studio", timeout: float = REQUEST_TIMEOUT):
+        self.base_url = base_url
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                max_keepalive_connections=MAX_CONNECTIONS),
+            timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+        )
+        # Повторы делает пул (на другом сервере), а не клиент
+        self.client = OpenAI(base_url=base_url, api_key=api_key, timeout=timeout,
+                             max_retries=0, http_client=self.http_client)
+        self.outstanding = 0
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def available(self, now: float) -> bool:
+        if self.opened_at is None:
+            return True
+        # Полуоткрытое состояние: после паузы пропускаем один пробный запрос
+        return not self.probing and now - self.opened_at >= COOLDOWN
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "outstanding": self.outstanding,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "open": self.opened_at is not None,
+        }
+
+
+class EndpointPool:
+    """
+    Маршрутизация запросов по нескольким серверам моделей:
+    наименьшее число запросов в полёте (при равенстве - меньшая задержка),
+    размыкание цепи после FAILURE_THRESHOLD ошибок подряд, повтор на другом сервере.
+    На сервер одновременно уходит не больше MAX_CONNECTIONS запросов (размер его
+    пула соединений): если все доступные серверы заняты, acquire ждёт освобождения.
+    Потокобезопасен.
+    """
+
+    def __init__(self, base_urls: list, api_key: str = "lm-studio", timeout: float = REQUEST_TIMEOUT):
+        if not base_urls:
+            raise ValueError("Нужен хотя бы один адрес сервера модели")
+        self.endpoints = [Endpoint(url, api_key, timeout) for url in base_urls]
+        self.lock = threading.Condition()
+
+    def acquire(self, exclude=(), timeout: float = REQUEST_TIMEOUT) -> Endpoint:
+        """Сервер для следующего запроса; ждёт не дольше timeout, пока все доступные заняты."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                candidates = [e for e in self.endpoints if e not in exclude and e.available(now)]
+                if not candidates:
+                    raise NoEndpointAvailable("Все серверы модели недоступны")
+                free = [e for e in candidates if e.outstanding < MAX_CONNECTIONS]
+                if free:
+                    break
+                # Все доступные серверы заняты до предела пула - ждём release
+                if now >= deadline:
+                    raise NoEndpointAvailable("Все серверы модели заняты")
+                self.lock.wait(deadline - now)
+            endpoint = min(free, key=lambda e: (e.outstanding, e.latency or 0.0))
+            if endpoint.opened_at is not None:
+                endpoint.probing = True
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, elapsed, ok: bool | None):
+        """
+        elapsed=None - сервер ответил, но время ответа не показательно (ошибка 4xx).
+        ok=None - запрос до сервера не дошёл: освобождается только место в полёте.
+        """
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.probing = False
+            self.lock.notify_all()
+            if ok is None:
+                return
+            endpoint.requests += 1
+            if ok:
+                endpoint.consecutive_failures = 0
+                endpoint.opened_at = None
+                if elapsed is None:
+                    return
+                if endpoint.latency is None:
+                    endpoint.latency = elapsed
+                else:
+                    endpoint.latency += LATENCY_ALPHA * (elapsed - endpoint.latency)
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.opened_at is not None or endpoint.consecutive_failures >= FAILURE_THRESHOLD:
+                if endpoint.opened_at is None:
+                    logging.warning("Сервер модели %s отключён на %.0f с", endpoint.base_url, COOLDOWN)
+                endpoint.opened_at = time.monotonic()
+
+    def chat_completion(self, **kwargs):
+        """
+        client.chat.completions.create на лучшем сервере; при сбое сервера или 429 - на следующем.
+        Остальные ошибки (4xx: неверный запрос, переполнение контекста) относятся к самому
+        запросу: они пробрасываются сразу и не размыкают цепь.
+        """
+        tried = []
+        last_error = None
+        for _ in range(len(self.endpoints)):
+            try:
+                endpoint = self.acquire(exclude=tried)
+            except NoEndpointAvailable:
+                break
+            tried.append(endpoint)
+            started = time.monotonic()
+            try:
+                resp = endpoint.client.chat.completions.create(**kwargs)
+            except openai.RateLimitError as e:
+                # Сервер жив, но перегружен: не сбой, просто пробуем другой
+                self.release(endpoint, None, ok=True)
+                last_error = e
+                continue
+            except Exception as e:
+                if is_pool_timeout(e):
+                    # Соединения этого клиента заняты - нагрузка наша, а не сбой сервера
+                    self.release(endpoint, None, ok=None)
+                    last_error = e
+                    continue
+                if not is_server_failure(e):
+                    self.release(endpoint, None, ok=True)
+                    raise
+                self.release(endpoint, time.monotonic() - started, ok=False)
+                logging.warning("Ошибка сервера модели %s: %s", endpoint.base_url, e)
+                last_error = e
+                continue
+            self.release(endpoint, time.monotonic() - started, ok=True)
+            return resp
+        raise NoEndpointAvailable("Ни один сервер модели не ответил") from last_error
+
+    def stats(self) -> list:
+        with self.lock:
+            return [e.stats() for e in self.endpoints]
+
+    def close(self):
+        for e in self.endpoints:
+            e.http_client.close()
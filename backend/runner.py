@@ -0,0 +1,202 @@
+"""
+Параллельный запуск многих комнат-симуляций (chat_ai.World).
+
+Комнаты делятся на шарды по процессам (CPU-часть: очистка текста, сходство),
+внутри процесса фиксированное число потоков по очереди делает ходы всех
+комнат шарда (ожидание ответа модели).
+Все реплики стекаются в общую очередь, из которой один поток пишет JSONL.
+Ctrl+C: комнаты доигрывают текущий ход и останавливаются; повторный Ctrl+C - жёсткий выход.
+
+    LM_ENDPOINTS=http://a:1234/v1,http://b:1234/v1 python runner.py --rooms 200 --processes 8
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import queue
+import signal
+import logging
+import argparse
+import itertools
+import threading
+import multiprocessing as mp
+
+RESULTS_PATH = "simulation_results.jsonl"
+THREADS_PER_PROCESS = 32
+SNAPSHOT_EVERY = 10
+SINK_POLL = 0.5
+STOP_POLL = 0.5  # как часто ждущий поток шарда проверяет stop (общий Event процессов)
+
+
+def shard_main(shard_id: int, world_ids: list, turns, topic: str, seed: int, sleep: float,
+               threads: int, results, stop):
+    # Останов только через stop: SIGINT ловит родитель и даёт комнатам доиграть ход
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import chat_ai  # при spawn у каждого процесса свой пул клиентов модели
+
+    # Комнат может быть больше, чем потоков: поток берёт комнату с самым ранним
+    # сроком следующего хода, делает ход и возвращает её в кучу с новым сроком.
+    # Куча, а не FIFO: сроки разные (пауза между ходами или COOLDOWN после
+    # NoEndpointAvailable), и отложенная комната не задерживает готовые.
+    ready = []  # (next_at, номер постановки, world)
+    order = itertools.count()
+    cond = threading.Condition()
+    workers = max(1, min(threads, len(world_ids)))
+    remaining = [len(world_ids)]
+
+    def schedule(world, next_at: float):
+        with cond:
+            heapq.heappush(ready, (next_at, next(order), world))
+            cond.notify()
+
+    def finish(record: dict):
+        results.put(record)
+        with cond:
+            remaining[0] -= 1
+            cond.notify_all()
+
+    def take():
+        """Комната, чей срок наступил (при останове - любая); None - все комнаты завершены."""
+        with cond:
+            while remaining[0]:
+                delay = STOP_POLL
+                if ready:
+                    delay = ready[0][0] - time.monotonic()
+                    if delay <= 0 or stop.is_set():
+                        return heapq.heappop(ready)[2]
+                cond.wait(min(delay, STOP_POLL))
+            return None
+
+    def work():
+        while True:
+            world = take()
+            if world is None:
+                return
+            if stop.is_set() or (turns is not None and world.turn >= turns):
+                finish({"type": "final", "world": world.world_id, "turn": world.turn,
+                               "relationships": world.snapshot_relationships()})
+                continue
+            try:
+                m = world.step()
+            except chat_ai.NoEndpointAvailable:
+                # Пул серверов общий на процесс: остальные комнаты тоже ждут, ход не засчитан
+                logging.warning("Серверы модели недоступны, комната %s ждёт %.0f с",
+                                world.world_id, chat_ai.COOLDOWN)
+                schedule(world, time.monotonic() + chat_ai.COOLDOWN)
+                continue
+            except Exception:
+                logging.exception("Комната %s остановлена с ошибкой", world.world_id)
+                finish({"type": "error", "world": world.world_id, "ts": time.time()})
+                continue
+            results.put({"type": "message", "world": world.world_id, "turn": world.turn,
+                         "name": m["name"], "text": m["text"], "ts": time.time()})
+            if world.turn % SNAPSHOT_EVERY == 0:
+                results.put({"type": "relationships", "world": world.world_id, "turn": world.turn,
+                             "relationships": world.snapshot_relationships()})
+            schedule(world, time.monotonic() + sleep)
+
+    for world_id in world_ids:
+        world = chat_ai.World(world_id, topic=topic or chat_ai.INITIAL_TOPIC, seed=f"{seed}:{world_id}")
+        m = world.start()
+        results.put({"type": "message", "world": world_id, "turn": 0,
+                     "name": m["name"], "text": m["text"], "ts": time.time()})
+        schedule(world, time.monotonic())
+
+    pool = [threading.Thread(target=work, name=f"shard-{shard_id}-{i}", daemon=True) for i in range(workers)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    results.put({"type": "shard_done", "shard": shard_id, "endpoints": chat_ai.model_pool.stats()})
+    chat_ai.model_pool.close()
+
+
+def sink_main(results, path: str, processes: list, totals: dict):
+    """Единственный писатель результатов: читает общую очередь до завершения всех шардов."""
+    done = 0
+    with open(path, "a", encoding="utf-8") as f:
+        while done < len(processes):
+            try:
+                record = results.get(timeout=SINK_POLL)
+            except queue.Empty:
+                # Шард мог упасть, не прислав shard_done
+                if not any(p.is_alive() for p in processes):
+                    break
+                continue
+            if record["type"] == "shard_done":
+                done += 1
+            totals[record["type"]] = totals.get(record["type"], 0) + 1
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if record["type"] in ("final", "shard_done", "error"):
+                f.flush()
+
+
+def run(rooms: int, processes: int, turns=None, topic: str = None, seed: int = 0, sleep: float = 0.0,
+        threads: int = THREADS_PER_PROCESS, results_path: str = RESULTS_PATH) -> dict:
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    stop = ctx.Event()
+    world_ids = [f"room-{i:04d}" for i in range(rooms)]
+    processes = max(1, min(processes, rooms))
+    shards = [world_ids[i::processes] for i in range(processes)]
+
+    workers = [
+        ctx.Process(target=shard_main, name=f"shard-{i}",
+                    args=(i, shard, turns, topic, seed, sleep, threads, results, stop))
+        for i, shard in enumerate(shards)
+    ]
+    for w in workers:
+        w.start()
+
+    totals = {}
+    sink = threading.Thread(target=sink_main, args=(results, results_path, workers, totals), daemon=True)
+    sink.start()
+
+    def on_sigint(signum, frame):
+        if stop.is_set():
+            print("\nЖёсткая остановка.")
+            for w in workers:
+                w.terminate()
+            return
+        print("\nОстанавливаемся: комнаты доигрывают текущий ход (повторный Ctrl+C - сразу)...")
+        stop.set()
+
+    previous = signal.signal(signal.SIGINT, on_sigint)
+    started = time.time()
+    try:
+        for w in workers:
+            while w.is_alive():
+                w.join(timeout=SINK_POLL)
+        sink.join()
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+    elapsed = time.time() - started
+    totals["elapsed"] = round(elapsed, 1)
+    totals["messages_per_sec"] = round(totals.get("message", 0) / elapsed, 2) if elapsed else 0.0
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Параллельный запуск комнат-симуляций")
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", type=int, default=THREADS_PER_PROCESS, help="потоков на процесс (ходов комнат одновременно)")
+    parser.add_argument("--turns", type=int, default=None, help="ходов на комнату (по умолчанию - до Ctrl+C)")
+    parser.add_argument("--topic", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sleep", type=float, default=0.0, help="пауза между ходами комнаты, с")
+    parser.add_argument("--out", default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(message)s")
+    totals = run(args.rooms, args.processes, turns=args.turns, topic=args.topic, seed=args.seed,
+                 sleep=args.sleep, threads=args.threads, results_path=args.out)
+    print(f"Готово: {totals} -> {args.out}")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Бенчмарк публичных методов VirtualWorldDB на синтетическом мире.
+Результаты пишутся в JSON, чтобы сравнивать прогоны между коммитами.
+
+Примеры:
+    python benchmark_db.py --preset small --output bench_before.json
+    python benchmark_db.py --compare bench_before.json bench_after.json
+"""
+
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+from database import VirtualWorldDB
+from generate_world import DEFAULT_END, PRESETS, generate_world, _character_id
+
+DEFAULT_REPEAT = 20
+# Сколько строк читать из потоковых iter_* за один вызов
+DRAIN_LIMIT = 5_000
+# Порог (во сколько раз медленнее), после которого --compare считает метод регрессией
+REGRESSION_RATIO = 1.2
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def _drain(rows, limit=DRAIN_LIMIT):
+    """Прочитать до limit строк из потокового iter_* и закрыть его"""
+    count = 0
+    try:
+        for _ in rows:
+            count += 1
+            if count >= limit:
+                break
+    finally:
+        rows.close()
+    return count
+
+
+def build_cases(db, counts, end=DEFAULT_END):
+    """
+    Сценарии вызова для каждого публичного метода VirtualWorldDB.
+    Каждый сценарий - функция без аргументов; i - номер повтора.
+    end - конец истории мира (как в generate_world), от него отсчитываются периоды.
+    """
+    hot = _character_id(0)        # самый активный персонаж (голова распределения)
+    tail = _character_id(counts['characters'] - 1)
+    now = datetime.utcfromtimestamp(end)
+    state = {'seq': max(0, db.get_last_change_seq() - 100)}
+
+    return {
+        'get_current_room': lambda i: db.get_current_room(),
+        'get_character_by_id': lambda i: db.get_character_by_id(tail if i % 2 else hot),
+        'get_character_history': lambda i: db.get_character_history(hot),
+        'search_characters': lambda i: db.search_characters('Персонаж 12'),
+        'save_message': lambda i: db.save_message(hot, f'бенчмарк {i}', {'mood': 'happy'}),
+        'get_chat_history': lambda i: db.get_chat_history(limit=50),
+        'iter_chat_history': lambda i: _drain(db.iter_chat_history(room_id='main-hall')),
+        'iter_character_messages': lambda i: _drain(db.iter_character_messages(hot)),
+        'update_relationship': lambda i: db.update_relationship(hot, tail, 'friend', 0.5),
+        'update_relationship_pair': lambda i: db.update_relationship_pair(hot, tail, 'friend', 0.5),
+        'update_relationships_bulk': lambda i: db.update_relationships_bulk(
+            [(hot, _character_id(k + 1), None, 0.01, None) for k in range(100)], delta=True),
+        'get_top_relationships': lambda i: db.get_top_relationships(hot, k=10),
+        'update_mood': lambda i: db.update_mood(hot, 0.4, 'бенчмарк'),
+        'update_mood_bulk': lambda i: db.update_mood_bulk(delta=0.01, room_id='main-hall', status='online'),
+        'compact_mood_history': lambda i: db.compact_mood_history(),
+        'get_mood_series': lambda i: db.get_mood_series(hot, now - timedelta(days=60), now),
+        'iter_mood_history': lambda i: _drain(db.iter_mood_history(hot)),
+        'prune_mood_history': lambda i: db.prune_mood_history(),
+        'get_room_stats': lambda i: db.get_room_stats(),
+        'set_world_state': lambda i: db.set_world_state('weather', 'rain' if i % 2 else 'sunny'),
+        'get_world_state': lambda i: db.get_world_state('weather'),
+        'get_last_change_seq': lambda i: db.get_last_change_seq(),
+        'get_changes': lambda i: db.get_changes(state['seq'], limit=100),
+        'wait_for_changes': lambda i: db.wait_for_changes(state['seq'], timeout=0),
+        'await_changes': lambda i: asyncio.run(db.await_changes(state['seq'], timeout=0)),
+        'trim_change_log': lambda i: db.trim_change_log(0),
+    }
+
+
+def public_methods():
+    return sorted(
+        name for name, member in inspect.getmembers(VirtualWorldDB)
+        if not name.startswith('_') and callable(member)
+    )
+
+
+def run_benchmark(db_name, counts, repeat=DEFAULT_REPEAT, only=None, compact_rows=False,
+                  end=DEFAULT_END):
+    """
+    Прогнать все сценарии и вернуть словарь результатов (мс на вызов)
+    """
+    db = VirtualWorldDB(db_name, compact_rows=compact_rows)
+    cases = build_cases(db, counts, end)
+
+    missing = [name for name in public_methods() if name not in cases]
+    if missing:
+        print(f"⚠️  Нет сценария для методов: {', '.join(missing)}", file=sys.stderr)
+
+    results = {}
+    for name, case in cases.items():
+        if only and name not in only:
+            continue
+        case(0)  # прогрев кэша страниц
+        samples = []
+        for i in range(repeat):
+            began = time.perf_counter()
+            case(i)
+            samples.append((time.perf_counter() - began) * 1000)
+        samples.sort()
+        results[name] = {
+            'median_ms': round(statistics.median(samples), 3),
+            'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+            'min_ms': round(samples[0], 3),
+            'max_ms': round(samples[-1], 3),
+            'repeat': repeat,
+        }
+        print(f"   {name:28s} median {results[name]['median_ms']:>10.3f} мс   "
+              f"p95 {results[name]['p95_ms']:>10.3f} мс")
+
+    return {
+        'commit': _git_commit(),
+        'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'counts': counts,
+        'compact_rows': compact_rows,
+        'missing_cases': missing,
+        'results': results,
+    }
+
+
+def compare(before_path, after_path, ratio=REGRESSION_RATIO):
+    """
+    Сравнить два JSON-отчета по медианам. Возвращает список регрессий.
+    """
+    with open(before_path, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(after_path, encoding='utf-8') as f:
+        after = json.load(f)
+
+    if before.get('counts') != after.get('counts'):
+        print("⚠️  Отчеты сняты на разных размерах мира", file=sys.stderr)
+
+    regressions = []
+    print(f"{'метод':28s} {before.get('commit') or 'before':>12s} {after.get('commit') or 'after':>12s}   x")
+    for name in sorted(set(before['results']) | set(after['results'])):
+        old = before['results'].get(name, {}).get('median_ms')
+        new = after['results'].get(name, {}).get('median_ms')
+        if old is None or new is None:
+            print(f"{name:28s} {old if old is not None else '-':>12} {new if new is not None else '-':>12}")
+            continue
+        factor = new / old if old else float('inf')
+        mark = ''
+        if factor > ratio:
+            mark = '  ⚠️'
+            regressions.append(name)
+        print(f"{name:28s} {old:>12.3f} {new:>12.3f}   {factor:.2f}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк VirtualWorldDB')
+    parser.add_argument('--db', default='bench_world.db')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--end', type=int, default=DEFAULT_END,
+                        help='конец истории мира, секунды UTC')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--reuse', action='store_true',
+                        help='не пересоздавать базу, если файл уже есть')
+    parser.add_argument('--only', nargs='*', help='только указанные методы')
+    parser.add_argument('--compact-rows', action='store_true',
+                        help='VirtualWorldDB(compact_rows=True): namedtuple вместо dict')
+    parser.add_argument('--output', help='куда сохранить JSON-отчет')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare)
+        sys.exit(1 if regressions else 0)
+
+    counts = PRESETS[args.preset]
+    if not (args.reuse and os.path.exists(args.db)):
+        print(f"Генерация мира {args.preset} -> {args.db}")
+        generate_world(args.db, seed=args.seed, end=args.end, **counts)
+
+    print(f"Бенчмарк ({args.repeat} повторов на метод):")
+    report = run_benchmark(args.db, counts, repeat=args.repeat, only=args.only,
+                           compact_rows=args.compact_rows, end=args.end)
+    report['preset'] = args.preset
+    report['seed'] = args.seed
+    report['end'] = args.end
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"✅ Отчет сохранен: {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,35 +8,98 @@
 
 import sqlite3
 import json
+import collections
+import functools
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
+import time
+import asyncio
+import heapq
+import threading
 
 # Имя файла базы данных
 DB_NAME = 'virtual_world.db'
 
+# Сколько хранить сырые строки mood_history и почасовые агрегаты (дни).
+# Посуточные агрегаты хранятся бессрочно.
+MOOD_RAW_RETENTION_DAYS = 30
+MOOD_HOUR_RETENTION_DAYS = 180
+
+# Размер пачки fetchmany для потоковых iter_* методов
+ITER_BATCH_SIZE = 500
+
+# Таблицы, изменения которых попадают в change_log: таблица -> ключевая колонка
+CHANGE_FEED_TABLES = {
+    'messages': 'id',
+    'characters': 'id',
+    'world_state': 'key',
+}
+
+# Колонки, по изменению которых пишется 'update' в ленту. Настроение и
+# last_active меняются массовыми тиками: тик попадает в ленту одной записью
+# 'mood_tick' (см. _apply_mood_bulk), а не строкой на каждого персонажа
+CHANGE_FEED_UPDATE_COLUMNS = {
+    'characters': ('name', 'avatar_url', 'personality_traits',
+                   'background_story', 'status', 'current_room'),
+}
+
+# Сколько последних записей хранит change_log; чистка - раз в
+# CHANGE_LOG_TRIM_EVERY вставок (триггер trg_change_log_retention)
+CHANGE_LOG_MAX_ROWS = 100000
+CHANGE_LOG_TRIM_EVERY = 1000
+
+# =========================================
+# ИДЕНТИФИКАТОРЫ
+# =========================================
+
+def generate_id(timestamp_ms=None, rng=None):
+    """
+    Упорядоченный по времени UUIDv7 (RFC 9562) в виде строки.
+    В отличие от uuid4 новые ключи попадают в конец B-дерева
+    индекса первичного ключа, а не на случайную страницу.
+    rng (random.Random) - источник случайных бит вместо os.urandom,
+    для воспроизводимых id (генератор мира).
+    """
+    if timestamp_ms is None:
+        timestamp_ms = time.time_ns() // 1_000_000
+    if rng is not None:
+        rand = rng.getrandbits(80)
+    else:
+        rand = int.from_bytes(os.urandom(10), 'big')
+    value = (timestamp_ms & 0xFFFFFFFFFFFF) << 80
+    value |= 0x7 << 76                      # версия 7
+    value |= ((rand >> 62) & 0xFFF) << 64   # rand_a
+    value |= 0b10 << 62                     # вариант RFC
+    value |= rand & 0x3FFFFFFFFFFFFFFF      # rand_b
+    return str(uuid.UUID(int=value))
+
+def is_time_ordered_id(value):
+    """Проверить, что id уже в формате UUIDv7"""
+    return isinstance(value, str) and len(value) == 36 and value[14] == '7'
+
 # =========================================
 # ПОДКЛЮЧЕНИЕ К БАЗЕ
 # =========================================
 
-def get_connection():
+def get_connection(db_name=None):
     """
     Создает подключение к SQLite базе данных.
     Возвращает connection и cursor.
     """
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(db_name or DB_NAME)
     # Включаем поддержку внешних ключей
     conn.execute("PRAGMA foreign_keys = ON")
     # Возвращаем строки как словари
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_database():
+def init_database(db_name=None):
     """
     Инициализирует базу данных: создает все таблицы, если их нет.
     Запускать при старте приложения.
     """
-    conn = get_connection()
+    conn = get_connection(db_name)
     cursor = conn.cursor()
     
     # ========== ТАБЛИЦА ПЕРСОНАЖЕЙ ==========
@@ -104,7 +167,7 @@ def init_database():
     # ========== ТАБЛИЦА ИСТОРИИ НАСТРОЕНИЯ ==========
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS mood_history (
-            id TEXT PRIMARY KEY DEFAULT (lower(hex(randomblob(16)))),
+            id INTEGER PRIMARY KEY,  -- rowid: новые строки дописываются в конец B-дерева
             character_id TEXT NOT NULL,
             mood_value REAL,
             reason TEXT,
@@ -113,6 +176,32 @@ def init_database():
         )
     ''')
     
+    # ========== АГРЕГАТЫ ИСТОРИИ НАСТРОЕНИЯ ==========
+    # Почасовые и посуточные min/max/avg/last для графиков за длинные периоды
+    for rollup_table in ('mood_rollup_hour', 'mood_rollup_day'):
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {rollup_table} (
+                character_id TEXT NOT NULL,
+                bucket TIMESTAMP NOT NULL,  -- начало часа/суток
+                min_value REAL,
+                max_value REAL,
+                sum_value REAL,
+                count INTEGER,
+                last_value REAL,
+                last_at TIMESTAMP,
+                PRIMARY KEY (character_id, bucket),
+                FOREIGN KEY (character_id) REFERENCES characters(id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+        ''')
+    
+    # Служебная таблица: до какого rowid сырые строки уже свернуты
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            watermark INTEGER
+        )
+    ''')
+    
     # ========== ТАБЛИЦА СОСТОЯНИЯ МИРА ==========
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS world_state (
@@ -122,18 +211,198 @@ def init_database():
         )
     ''')
     
+    # ========== ЛЕНТА ИЗМЕНЕНИЙ ==========
+    # Монотонный журнал (AUTOINCREMENT не переиспользует seq после удаления),
+    # заполняется триггерами на messages / characters / world_state
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            op TEXT NOT NULL,  -- insert / update / delete / mood_tick
+            row_key TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    for table_name, key_column in CHANGE_FEED_TABLES.items():
+        for op, row in (('insert', 'NEW'), ('delete', 'OLD')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table_name}_{op}_feed
+                AFTER {op.upper()} ON {table_name}
+                BEGIN
+                    INSERT INTO change_log (table_name, op, row_key)
+                    VALUES ('{table_name}', '{op}', {row}.{key_column});
+                END
+            ''')
+        # update - только если ключ не изменился и только по колонкам
+        # из CHANGE_FEED_UPDATE_COLUMNS, если они заданы для таблицы
+        columns = CHANGE_FEED_UPDATE_COLUMNS.get(table_name)
+        of_columns = f' OF {", ".join(columns)}' if columns else ''
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table_name}_update_feed
+            AFTER UPDATE{of_columns} ON {table_name}
+            WHEN OLD.{key_column} IS NEW.{key_column}
+            BEGIN
+                INSERT INTO change_log (table_name, op, row_key)
+                VALUES ('{table_name}', 'update', NEW.{key_column});
+            END
+        ''')
+        # Смена ключа (migrate_to_time_ordered_ids) для подписчиков - удаление
+        # строки со старым ключом и вставка с новым, соседними seq
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table_name}_rekey_feed
+            AFTER UPDATE OF {key_column} ON {table_name}
+            WHEN OLD.{key_column} IS NOT NEW.{key_column}
+            BEGIN
+                INSERT INTO change_log (table_name, op, row_key)
+                VALUES ('{table_name}', 'delete', OLD.{key_column});
+                INSERT INTO change_log (table_name, op, row_key)
+                VALUES ('{table_name}', 'insert', NEW.{key_column});
+            END
+        ''')
+    
+    # Хранение журнала: каждая CHANGE_LOG_TRIM_EVERY-я запись удаляет все,
+    # что старше CHANGE_LOG_MAX_ROWS последних (удаление по диапазону seq)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_change_log_retention
+        AFTER INSERT ON change_log
+        WHEN NEW.seq % {CHANGE_LOG_TRIM_EVERY} = 0
+        BEGIN
+            DELETE FROM change_log WHERE seq <= NEW.seq - {CHANGE_LOG_MAX_ROWS};
+        END
+    ''')
+    
     # ========== СОЗДАНИЕ ИНДЕКСОВ ==========
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_character ON messages(character_id)')
+    # (character_id, created_at) заменяет прежний idx_messages_character: лента персонажа без сортировки
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_character')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_character_created ON messages(character_id, created_at DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_room ON messages(room_id, created_at DESC)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_created ON messages(created_at DESC)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_characters_status ON characters(status)')
+    # (status, current_room) покрывает и запросы только по status. last_active
+    # в индекс не входит: его переписывает каждый тик настроения, а ростер комнаты мал
+    cursor.execute('DROP INDEX IF EXISTS idx_characters_status')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_characters_status_room ON characters(status, current_room)')
+    # Тик по одной комнате без фильтра по статусу (update_mood_bulk(room_id=...))
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_characters_room ON characters(current_room)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_character ON character_events(character_id, created_at DESC)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_mood_character ON mood_history(character_id, created_at DESC)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_relationships_character ON relationships(character_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mood_created ON mood_history(created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mood_rollup_hour_bucket ON mood_rollup_hour(bucket)')
+    # Покрывающий индекс для топ-k соседей: сортировка по силе без обращения к таблице.
+    # Его префикс (character_id) заменяет прежний idx_relationships_character
+    cursor.execute('DROP INDEX IF EXISTS idx_relationships_character')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_relationships_strength ON relationships(character_id, strength, related_character_id)')
     
     conn.commit()
     conn.close()
     print("✅ База данных инициализирована")
 
+# =========================================
+# МИГРАЦИЯ КЛЮЧЕЙ
+# =========================================
+
+# Таблицы со случайными uuid4-ключами и колонка времени, из которой строится UUIDv7
+TIME_ORDERED_ID_TABLES = {
+    'messages': 'created_at',
+    'relationships': 'last_interaction',
+    'character_events': 'created_at',
+}
+
+def migrate_to_time_ordered_ids(batch_size=1000, pause=0.0, db_name=None):
+    """
+    Онлайн-миграция: заменяет старые uuid4-ключи на UUIDv7, построенные
+    из времени создания строки. Работает небольшими транзакциями,
+    поэтому база остается доступной; повторный запуск продолжает с места остановки.
+    После миграции id сообщений меняются: в change_log каждая замена - это
+    'delete' старого id и следующая за ней 'insert' нового.
+    Возвращает {таблица: количество перезаписанных строк}.
+    """
+    conn = get_connection(db_name)
+    cursor = conn.cursor()
+    migrated = {}
+    
+    for table_name, time_column in TIME_ORDERED_ID_TABLES.items():
+        migrated[table_name] = 0
+        last_rowid = 0
+        while True:
+            cursor.execute(f'''
+                SELECT rowid, id, {time_column}
+                FROM {table_name}
+                WHERE rowid > ?
+                ORDER BY rowid
+                LIMIT ?
+            ''', (last_rowid, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            
+            updates = []
+            for rowid, row_id, created_at in rows:
+                if is_time_ordered_id(row_id):
+                    continue
+                if created_at:
+                    moment = datetime.fromisoformat(created_at).replace(tzinfo=timezone.utc)
+                    timestamp_ms = int(moment.timestamp() * 1000)
+                else:
+                    timestamp_ms = None
+                updates.append((generate_id(timestamp_ms), rowid))
+            
+            if updates:
+                cursor.executemany(f'UPDATE {table_name} SET id = ? WHERE rowid = ?', updates)
+                conn.commit()
+                migrated[table_name] += len(updates)
+            if pause:
+                time.sleep(pause)
+    
+    conn.close()
+    print(f"✅ Ключи переведены на UUIDv7: {migrated}")
+    return migrated
+
+def migrate_mood_history_keys(db_name=None):
+    """
+    Перестроить mood_history старого формата (id TEXT со случайным значением)
+    в таблицу с id INTEGER PRIMARY KEY. Случайный ключ ставит каждую новую
+    строку на случайную страницу B-дерева, и массовый тик настроения
+    упирается в запись этих страниц.
+    Офлайн-операция: таблица копируется целиком в одной транзакции.
+    rowid строк сохраняются, поэтому watermark агрегатов остается верным.
+    Возвращает количество перенесенных строк (0, если база уже в новом формате).
+    """
+    conn = get_connection(db_name)
+    cursor = conn.cursor()
+    
+    cursor.execute('PRAGMA table_info(mood_history)')
+    columns = {row['name']: row['type'] for row in cursor.fetchall()}
+    if columns.get('id', 'INTEGER').upper() == 'INTEGER':
+        conn.close()
+        return 0
+    
+    cursor.execute('''
+        CREATE TABLE mood_history_new (
+            id INTEGER PRIMARY KEY,
+            character_id TEXT NOT NULL,
+            mood_value REAL,
+            reason TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (character_id) REFERENCES characters(id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO mood_history_new (id, character_id, mood_value, reason, created_at)
+        SELECT rowid, character_id, mood_value, reason, created_at FROM mood_history
+    ''')
+    moved = cursor.rowcount
+    cursor.execute('DROP TABLE mood_history')
+    cursor.execute('ALTER TABLE mood_history_new RENAME TO mood_history')
+    conn.commit()
+    conn.close()
+    
+    # Индексы mood_history удалены вместе со старой таблицей
+    init_database(db_name)
+    print(f"✅ mood_history перестроена: {moved} строк")
+    return moved
+
 # =========================================
 # ТЕСТОВЫЕ ДАННЫЕ
 # =========================================
@@ -188,26 +457,22 @@ def insert_sample_data():
     
     # 2. Добавляем отношения
     relationships = [
-        (str(uuid.uuid4()), '11111111-1111-1111-1111-111111111111', '22222222-2222-2222-2222-222222222222', 'friend', 0.8, 'Элис и Боб часто общаются'),
-        (str(uuid.uuid4()), '11111111-1111-1111-1111-111111111111', '33333333-3333-3333-3333-333333333333', 'best_friend', 0.9, 'Элис и Каролина неразлучны'),
-        (str(uuid.uuid4()), '22222222-2222-2222-2222-222222222222', '33333333-3333-3333-3333-333333333333', 'neutral', 0.2, 'Боб и Каролина иногда спорят')
+        (generate_id(), '11111111-1111-1111-1111-111111111111', '22222222-2222-2222-2222-222222222222', 'friend', 0.8, 'Элис и Боб часто общаются'),
+        (generate_id(), '11111111-1111-1111-1111-111111111111', '33333333-3333-3333-3333-333333333333', 'best_friend', 0.9, 'Элис и Каролина неразлучны'),
+        (generate_id(), '22222222-2222-2222-2222-222222222222', '33333333-3333-3333-3333-333333333333', 'neutral', 0.2, 'Боб и Каролина иногда спорят')
     ]
     
-    cursor.executemany('''
-        INSERT OR REPLACE INTO relationships 
-        (id, character_id, related_character_id, relationship_type, strength, memory_summary)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', relationships)
+    cursor.executemany(RELATIONSHIP_UPSERT_SQL, relationships)
     
     # 3. Добавляем сообщения
     messages = [
-        (str(uuid.uuid4()), '11111111-1111-1111-1111-111111111111', 
+        (generate_id(), '11111111-1111-1111-1111-111111111111', 
          'Привет всем! Как ваше настроение сегодня?',
          json.dumps({"mood": "happy", "intensity": 0.8}), 0, 0, 'main-hall'),
-        (str(uuid.uuid4()), '22222222-2222-2222-2222-222222222222',
+        (generate_id(), '22222222-2222-2222-2222-222222222222',
          'Привет, Элис. У меня всё хорошо, думаю над новым проектом.',
          json.dumps({"mood": "thoughtful", "intensity": 0.6}), 0, 0, 'main-hall'),
-        (str(uuid.uuid4()), '33333333-3333-3333-3333-333333333333',
+        (generate_id(), '33333333-3333-3333-3333-333333333333',
          'Ой, а я только что видела прекрасный сон!',
          json.dumps({"mood": "excited", "intensity": 0.9}), 0, 0, 'main-hall')
     ]
@@ -233,11 +498,13 @@ def insert_sample_data():
     
     # 5. Состояние мира
     cursor.execute('''
-        INSERT OR REPLACE INTO world_state (key, value) VALUES (?, ?)
+        INSERT INTO world_state (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
     ''', ('weather', 'sunny'))
     
     cursor.execute('''
-        INSERT OR REPLACE INTO world_state (key, value) VALUES (?, ?)
+        INSERT INTO world_state (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
     ''', ('time_of_day', 'day'))
     
     conn.commit()
@@ -248,11 +515,153 @@ def insert_sample_data():
 # ОСНОВНЫЕ ЗАПРОСЫ (API для вашего бэкенда)
 # =========================================
 
+# Настоящий upsert: при конфликте пары строка обновляется на месте,
+# без DELETE + INSERT, каскадов и смены id. Значения перезаписываются
+# целиком, как раньше при INSERT OR REPLACE (None очищает поле)
+RELATIONSHIP_UPSERT_SQL = '''
+    INSERT INTO relationships 
+    (id, character_id, related_character_id, relationship_type, strength, memory_summary, last_interaction)
+    VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(character_id, related_character_id) DO UPDATE SET
+        relationship_type = excluded.relationship_type,
+        strength = excluded.strength,
+        memory_summary = excluded.memory_summary,
+        last_interaction = CURRENT_TIMESTAMP
+'''
+
+# Текстовое настроение по значению - те же пороги, что и в update_mood
+MOOD_LABEL_SQL = '''
+    CASE
+        WHEN {v} > 0.6 THEN 'excited'
+        WHEN {v} > 0.3 THEN 'happy'
+        WHEN {v} > 0.1 THEN 'content'
+        WHEN {v} > -0.1 THEN 'neutral'
+        WHEN {v} > -0.4 THEN 'sad'
+        WHEN {v} > -0.7 THEN 'angry'
+        ELSE 'miserable'
+    END
+'''
+
+# strength - приращение к текущему значению; relationship_type и
+# memory_summary, равные None, сохраняют прежние значения
+RELATIONSHIP_DELTA_SQL = '''
+    INSERT INTO relationships 
+    (id, character_id, related_character_id, relationship_type, strength, memory_summary, last_interaction)
+    VALUES (?, ?, ?, ?, MAX(-1.0, MIN(1.0, ?)), ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(character_id, related_character_id) DO UPDATE SET
+        relationship_type = COALESCE(excluded.relationship_type, relationships.relationship_type),
+        strength = MAX(-1.0, MIN(1.0, COALESCE(relationships.strength, 0) + excluded.strength)),
+        memory_summary = COALESCE(excluded.memory_summary, relationships.memory_summary),
+        last_interaction = CURRENT_TIMESTAMP
+'''
+
+@functools.lru_cache(maxsize=256)
+def _record_type(columns):
+    """Класс namedtuple для набора колонок (один на форму запроса)"""
+    return collections.namedtuple('Record', columns, rename=True)
+
+def _parse_timestamp(value):
+    """Привести datetime или строку SQLite-формата к datetime"""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+def _wake(future, error=None):
+    """Разбудить ожидающего (вызывается в потоке его цикла событий)"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(None)
+
+class _ChangeWatcher:
+    """
+    Один поток на все await_changes экземпляра VirtualWorldDB: следит за
+    PRAGMA data_version и будит futures, чей since_seq уже пройден.
+    Поток запускается первым ожидающим и завершается, когда ожидающих нет.
+    """
+    
+    def __init__(self, connect, poll_interval):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.waiters = []  # (since_seq, loop, future)
+        self.last_seq = None  # MAX(seq) по последнему опросу, пока поток жив
+        self.thread = None
+    
+    def add(self, since_seq, loop, future):
+        with self.lock:
+            if self.last_seq is not None and self.last_seq > since_seq:
+                future.set_result(None)
+                return
+            self.waiters.append((since_seq, loop, future))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='change-watcher', daemon=True)
+                self.thread.start()
+    
+    def remove(self, future):
+        with self.lock:
+            self.waiters = [w for w in self.waiters if w[2] is not future]
+    
+    @staticmethod
+    def _notify(waiters, error=None):
+        for _, loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future, error)
+            except RuntimeError:
+                pass  # цикл событий уже закрыт
+    
+    def _run(self):
+        conn = None
+        try:
+            conn = self.connect()
+            version = None
+            while True:
+                current = conn.execute('PRAGMA data_version').fetchone()[0]
+                ready = []
+                with self.lock:
+                    if current != version:
+                        version = current
+                        self.last_seq = conn.execute(
+                            'SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+                        ready = [w for w in self.waiters if w[0] < self.last_seq]
+                        self.waiters = [w for w in self.waiters if w[0] >= self.last_seq]
+                    idle = not self.waiters
+                    if idle:
+                        self.thread = None
+                        self.last_seq = None
+                self._notify(ready)
+                if idle:
+                    return
+                time.sleep(self.poll_interval)
+        except Exception as e:
+            with self.lock:
+                failed, self.waiters = self.waiters, []
+                self.thread = None
+                self.last_seq = None
+            self._notify(failed, e)
+        finally:
+            if conn is not None:
+                conn.close()
+
+def _bucket_start(ts, resolution):
+    """Начало часовой/суточной корзины для строки 'YYYY-MM-DD HH:MM:SS'"""
+    if resolution == 'hour':
+        return ts[:13] + ':00:00'
+    return ts[:10] + ' 00:00:00'
+
+
 class VirtualWorldDB:
     """Класс для работы с базой данных виртуального мира"""
     
-    def __init__(self, db_name=DB_NAME):
+    def __init__(self, db_name=DB_NAME, compact_rows=False):
         self.db_name = db_name
+        # True - списки строк возвращаются как namedtuple (имена колонок общие
+        # на запрос), а не как отдельный dict на каждую строку
+        self.compact_rows = compact_rows
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
     
     def _get_conn(self):
         """Внутренний метод для получения подключения"""
@@ -261,6 +670,34 @@ class VirtualWorldDB:
         conn.row_factory = sqlite3.Row
         return conn
     
+    def _materialize(self, description, rows):
+        """Превратить строки sqlite3.Row в dict или компактные записи"""
+        if not self.compact_rows:
+            return [dict(row) for row in rows]
+        record = _record_type(tuple(column[0] for column in description))
+        return [record._make(row) for row in rows]
+    
+    def _rows(self, cursor):
+        """Весь результат курсора в выбранном режиме"""
+        return self._materialize(cursor.description, cursor.fetchall())
+    
+    def _iter(self, sql, params=(), batch_size=None):
+        """
+        Потоковое чтение через fetchmany: в памяти не больше batch_size строк.
+        Подключение закрывается, когда генератор исчерпан или закрыт.
+        """
+        batch_size = batch_size or ITER_BATCH_SIZE
+        conn = self._get_conn()
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield from self._materialize(cursor.description, batch)
+        finally:
+            conn.close()
+    
     # ----- КОМНАТА -----
     
     def get_current_room(self):
@@ -278,20 +715,24 @@ class VirtualWorldDB:
             WHERE status = 'online' AND current_room = 'main-hall'
             ORDER BY last_active DESC
         ''')
-        characters = [dict(row) for row in cursor.fetchall()]
+        characters = self._rows(cursor)
         
         # Последние сообщения
+        # Внутренний запрос берет 20 последних по индексу, внешний
+        # отдает их в хронологическом порядке
         cursor.execute('''
-            SELECT m.id, m.character_id, m.content, m.emotion_context, 
-                   m.created_at, c.name as character_name, c.avatar_url
-            FROM messages m
-            JOIN characters c ON c.id = m.character_id
-            WHERE m.room_id = 'main-hall'
-            ORDER BY m.created_at DESC
-            LIMIT 20
+            SELECT * FROM (
+                SELECT m.id, m.character_id, m.content, m.emotion_context, 
+                       m.created_at, c.name as character_name, c.avatar_url
+                FROM messages m
+                JOIN characters c ON c.id = m.character_id
+                WHERE m.room_id = 'main-hall'
+                ORDER BY m.created_at DESC
+                LIMIT 20
+            )
+            ORDER BY created_at
         ''')
-        messages = [dict(row) for row in cursor.fetchall()]
-        messages.reverse()  # для хронологического порядка
+        messages = self._rows(cursor)
         
         conn.close()
         
@@ -353,18 +794,25 @@ class VirtualWorldDB:
             ORDER BY created_at DESC
             LIMIT 50
         ''', (character_id,))
-        result['messages'] = [dict(row) for row in cursor.fetchall()]
+        result['messages'] = self._rows(cursor)
         
         # Отношения
         cursor.execute('''
             SELECT c.name as character_name, r.relationship_type, 
                    r.strength, r.memory_summary, r.last_interaction
-            FROM relationships r
+            FROM relationships r INDEXED BY idx_relationships_strength
             JOIN characters c ON c.id = r.related_character_id
             WHERE r.character_id = ?
-            ORDER BY ABS(r.strength) DESC
+            ORDER BY r.strength DESC
         ''', (character_id,))
-        result['relationships'] = [dict(row) for row in cursor.fetchall()]
+        # Порядок по ABS(strength) без сортировки: положительные уже идут по убыванию,
+        # отрицательные - перевернуть, и слить два упорядоченных списка
+        rows = cursor.fetchall()
+        positive = [row for row in rows if (row['strength'] or 0) >= 0]
+        negative = [row for row in reversed(rows) if (row['strength'] or 0) < 0]
+        result['relationships'] = self._materialize(cursor.description, heapq.merge(
+            positive, negative, key=lambda row: abs(row['strength'] or 0), reverse=True
+        ))
         
         # События
         cursor.execute('''
@@ -374,7 +822,7 @@ class VirtualWorldDB:
             ORDER BY created_at DESC
             LIMIT 20
         ''', (character_id,))
-        result['events'] = [dict(row) for row in cursor.fetchall()]
+        result['events'] = self._rows(cursor)
         
         # История настроения
         cursor.execute('''
@@ -384,7 +832,7 @@ class VirtualWorldDB:
             ORDER BY created_at DESC
             LIMIT 10
         ''', (character_id,))
-        result['mood_history'] = [dict(row) for row in cursor.fetchall()]
+        result['mood_history'] = self._rows(cursor)
         
         conn.close()
         return result
@@ -403,7 +851,7 @@ class VirtualWorldDB:
             LIMIT 20
         ''', (f'%{query}%', f'%{query}%'))
         
-        results = [dict(row) for row in cursor.fetchall()]
+        results = self._rows(cursor)
         conn.close()
         return results
     
@@ -414,7 +862,7 @@ class VirtualWorldDB:
         """
         Сохранить новое сообщение
         """
-        message_id = str(uuid.uuid4())
+        message_id = generate_id()
         conn = self._get_conn()
         cursor = conn.cursor()
         
@@ -439,52 +887,159 @@ class VirtualWorldDB:
         conn = self._get_conn()
         cursor = conn.cursor()
         
+        # Последние limit сообщений по индексу, наружу - в хронологическом порядке
         if before:
             cursor.execute('''
-                SELECT m.id, m.character_id, m.content, m.emotion_context, 
-                       m.created_at, m.is_user, m.is_system,
-                       c.name as character_name, c.avatar_url
-                FROM messages m
-                JOIN characters c ON c.id = m.character_id
-                WHERE m.created_at < ?
-                ORDER BY m.created_at DESC
-                LIMIT ?
+                SELECT * FROM (
+                    SELECT m.id, m.character_id, m.content, m.emotion_context, 
+                           m.created_at, m.is_user, m.is_system,
+                           c.name as character_name, c.avatar_url
+                    FROM messages m
+                    JOIN characters c ON c.id = m.character_id
+                    WHERE m.created_at < ?
+                    ORDER BY m.created_at DESC
+                    LIMIT ?
+                )
+                ORDER BY created_at
             ''', (before, limit))
         else:
             cursor.execute('''
-                SELECT m.id, m.character_id, m.content, m.emotion_context, 
-                       m.created_at, m.is_user, m.is_system,
-                       c.name as character_name, c.avatar_url
-                FROM messages m
-                JOIN characters c ON c.id = m.character_id
-                ORDER BY m.created_at DESC
-                LIMIT ?
+                SELECT * FROM (
+                    SELECT m.id, m.character_id, m.content, m.emotion_context, 
+                           m.created_at, m.is_user, m.is_system,
+                           c.name as character_name, c.avatar_url
+                    FROM messages m
+                    JOIN characters c ON c.id = m.character_id
+                    ORDER BY m.created_at DESC
+                    LIMIT ?
+                )
+                ORDER BY created_at
             ''', (limit,))
         
-        messages = [dict(row) for row in cursor.fetchall()]
-        messages.reverse()
+        messages = self._rows(cursor)
         conn.close()
         return messages
     
+    def iter_chat_history(self, room_id=None, since=None, batch_size=None):
+        """
+        Потоковая выгрузка сообщений в хронологическом порядке (для экспорта).
+        room_id - только одна комната, since - только сообщения позже этой метки.
+        """
+        conditions = []
+        params = []
+        if room_id is not None:
+            conditions.append('m.room_id = ?')
+            params.append(room_id)
+        if since is not None:
+            conditions.append('m.created_at > ?')
+            params.append(since)
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        
+        return self._iter(f'''
+            SELECT m.id, m.character_id, m.content, m.emotion_context, 
+                   m.created_at, m.is_user, m.is_system, m.room_id,
+                   c.name as character_name, c.avatar_url
+            FROM messages m
+            LEFT JOIN characters c ON c.id = m.character_id
+            {where}
+            ORDER BY m.created_at
+        ''', params, batch_size)
+    
+    def iter_character_messages(self, character_id, batch_size=None):
+        """
+        Потоковая выгрузка всех сообщений персонажа, от новых к старым
+        """
+        return self._iter('''
+            SELECT id, content, emotion_context, room_id, created_at
+            FROM messages
+            WHERE character_id = ?
+            ORDER BY created_at DESC
+        ''', (character_id,), batch_size)
+    
     # ----- ОТНОШЕНИЯ -----
     
     def update_relationship(self, char1_id, char2_id, relationship_type, strength, memory=None):
         """
-        Обновить отношения между персонажами
+        Обновить отношения между персонажами.
+        Существующая строка обновляется на месте (id не меняется),
+        все поля перезаписываются: None очищает relationship_type / memory.
         """
         conn = self._get_conn()
         cursor = conn.cursor()
         
-        rel_id = str(uuid.uuid4())
-        cursor.execute('''
-            INSERT OR REPLACE INTO relationships 
-            (id, character_id, related_character_id, relationship_type, strength, memory_summary, last_interaction)
-            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (rel_id, char1_id, char2_id, relationship_type, strength, memory))
+        cursor.execute(RELATIONSHIP_UPSERT_SQL, (
+            generate_id(), char1_id, char2_id, relationship_type, strength, memory
+        ))
         
         conn.commit()
         conn.close()
     
+    def update_relationship_pair(self, char1_id, char2_id, relationship_type, strength, memory=None):
+        """
+        Симметрично обновить отношения в обе стороны одной транзакцией
+        """
+        self.update_relationships_bulk([
+            (char1_id, char2_id, relationship_type, strength, memory),
+            (char2_id, char1_id, relationship_type, strength, memory),
+        ])
+    
+    def update_relationships_bulk(self, updates, delta=False):
+        """
+        Применить пачку изменений отношений (за ход или тик) одной транзакцией.
+        updates: список кортежей (char1_id, char2_id, relationship_type, strength, memory).
+        Без delta поля перезаписываются, как в update_relationship.
+        При delta=True strength прибавляется к текущему значению
+        (с ограничением в [-1, 1]); relationship_type и memory, равные None,
+        сохраняют прежние значения.
+        """
+        sql = RELATIONSHIP_DELTA_SQL if delta else RELATIONSHIP_UPSERT_SQL
+        rows = [
+            (generate_id(), char1_id, char2_id, relationship_type, strength, memory)
+            for char1_id, char2_id, relationship_type, strength, memory in updates
+        ]
+        if not rows:
+            return 0
+        
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        
+        cursor.executemany(sql, rows)
+        
+        conn.commit()
+        conn.close()
+        return len(rows)
+    
+    def get_top_relationships(self, character_id, k=5):
+        """
+        Топ-k самых сильных отношений персонажа (по модулю strength).
+        Оба конца диапазона читаются из индекса idx_relationships_strength,
+        поэтому сортировки ABS(strength) на каждый запрос нет.
+        """
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        
+        rows = []
+        for order in ('DESC', 'ASC'):
+            cursor.execute(f'''
+                SELECT r.related_character_id, r.strength, c.name as character_name
+                FROM (
+                    SELECT related_character_id, strength
+                    FROM relationships INDEXED BY idx_relationships_strength
+                    WHERE character_id = ?
+                    ORDER BY strength {order}
+                    LIMIT ?
+                ) r
+                JOIN characters c ON c.id = r.related_character_id
+            ''', (character_id, k))
+            rows.extend(cursor.fetchall())
+        description = cursor.description
+        conn.close()
+        
+        # Положительный и отрицательный концы могут пересекаться при малом числе связей
+        unique = {row['related_character_id']: row for row in rows}
+        top = sorted(unique.values(), key=lambda row: abs(row['strength'] or 0), reverse=True)[:k]
+        return self._materialize(description, top)
+    
     # ----- ЭМОЦИИ -----
     
     def update_mood(self, character_id, mood_value, reason=None):
@@ -517,6 +1072,13 @@ class VirtualWorldDB:
             WHERE id = ?
         ''', (mood_text, mood_value, character_id))
         
+        # Настроение не входит в колонки триггера ленты - пишем явно
+        if cursor.rowcount:
+            cursor.execute('''
+                INSERT INTO change_log (table_name, op, row_key)
+                VALUES ('characters', 'update', ?)
+            ''', (character_id,))
+        
         # Сохраняем в историю
         cursor.execute('''
             INSERT INTO mood_history (character_id, mood_value, reason)
@@ -528,6 +1090,306 @@ class VirtualWorldDB:
         
         return {'mood': mood_text, 'value': mood_value}
     
+    def update_mood_bulk(self, delta=None, target=None, room_id=None, status=None, reason=None):
+        """
+        Изменить настроение сразу у группы персонажей одной транзакцией.
+        delta - сдвиг текущего значения, target - новое значение (одно из двух).
+        room_id / status - фильтры (None = без фильтра).
+        Возвращает количество затронутых персонажей.
+        """
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        
+        count = self._apply_mood_bulk(cursor, delta=delta, target=target,
+                                      room_id=room_id, status=status, reason=reason)
+        
+        conn.commit()
+        conn.close()
+        return count
+    
+    def _apply_mood_bulk(self, cursor, delta=None, target=None, room_id=None, status=None, reason=None):
+        """
+        Внутренний метод: UPDATE персонажей + INSERT...SELECT в mood_history.
+        Метка настроения считается в SQL, без цикла по персонажам в Python.
+        """
+        if (delta is None) == (target is None):
+            raise ValueError("Нужно указать ровно одно из: delta, target")
+        
+        # Именованные параметры: выражение значения повторяется внутри CASE
+        params = {
+            'value': delta if delta is not None else target,
+            'status': status,
+            'room_id': room_id,
+            'reason': reason,
+        }
+        conditions = []
+        if status is not None:
+            conditions.append('status = :status')
+        if room_id is not None:
+            conditions.append('current_room = :room_id')
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        
+        if delta is not None:
+            value_sql = 'MAX(-1.0, MIN(1.0, COALESCE(mood_value, 0) + :value))'
+        else:
+            value_sql = 'MAX(-1.0, MIN(1.0, :value))'
+        
+        cursor.execute(f'''
+            UPDATE characters
+            SET mood_value = {value_sql},
+                current_mood = {MOOD_LABEL_SQL.format(v=value_sql)},
+                last_active = CURRENT_TIMESTAMP
+            {where}
+        ''', params)
+        count = cursor.rowcount
+        
+        # В ленту - одна запись на тик: ключом служат параметры тика (JSON)
+        if count:
+            cursor.execute('''
+                INSERT INTO change_log (table_name, op, row_key)
+                VALUES ('characters', 'mood_tick', ?)
+            ''', (json.dumps({'room_id': room_id, 'status': status, 'delta': delta,
+                              'target': target, 'count': count}),))
+        
+        # Порядок по id: вставки в idx_mood_character идут слева направо
+        # по индексу, а не на случайные страницы
+        cursor.execute(f'''
+            INSERT INTO mood_history (character_id, mood_value, reason)
+            SELECT id, mood_value, :reason
+            FROM characters
+            {where}
+            ORDER BY id
+        ''', params)
+        
+        return count
+    
+    # ----- ИСТОРИЯ НАСТРОЕНИЯ (АГРЕГАТЫ) -----
+    
+    def compact_mood_history(self):
+        """
+        Свернуть новые строки mood_history в почасовые и посуточные агрегаты.
+        Новые - это строки с rowid больше watermark, независимо от created_at:
+        строки той же секунды и задним числом тоже попадают в свертку.
+        Они добавляются к уже посчитанным корзинам, поэтому сырые строки,
+        удаленные prune_mood_history, для пересчета не нужны.
+        Запускать периодически (например, по тику мира). Возвращает новый watermark.
+        """
+        conn = self._get_conn()
+        # Чтение watermark, свертка и его сдвиг - одна транзакция записи:
+        # параллельная свертка ждет блокировку и уже видит новый watermark
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            cursor.execute("SELECT watermark FROM rollup_state WHERE name = 'mood_history'")
+            row = cursor.fetchone()
+            watermark = row[0] if row and row[0] is not None else 0
+            
+            cursor.execute('SELECT MAX(rowid) FROM mood_history')
+            newest = cursor.fetchone()[0]
+            if newest is None or newest <= watermark:
+                cursor.execute('COMMIT')
+                return watermark
+            
+            # Обе корзины считаются из одних и тех же новых сырых строк и сливаются
+            # с существующими: min/max/sum/count складываются, last - по last_at
+            # (при равенстве побеждает новая строка)
+            params = {'after': watermark, 'upto': newest}
+            for table, bucket_sql in (
+                ('mood_rollup_hour', "strftime('%Y-%m-%d %H:00:00', created_at)"),
+                ('mood_rollup_day', "date(created_at) || ' 00:00:00'"),
+            ):
+                cursor.execute(f'''
+                    INSERT INTO {table}
+                    (character_id, bucket, min_value, max_value, sum_value, count, last_value, last_at)
+                    SELECT g.character_id, g.bucket, g.min_value, g.max_value, g.sum_value, g.count,
+                           (SELECT h.mood_value FROM mood_history h
+                            WHERE h.character_id = g.character_id AND h.created_at = g.last_at
+                              AND h.rowid > :after AND h.rowid <= :upto
+                            ORDER BY h.rowid DESC LIMIT 1),
+                           g.last_at
+                    FROM (
+                        SELECT character_id,
+                               {bucket_sql} as bucket,
+                               MIN(mood_value) as min_value, MAX(mood_value) as max_value,
+                               TOTAL(mood_value) as sum_value, COUNT(mood_value) as count,
+                               MAX(created_at) as last_at
+                        FROM mood_history
+                        WHERE rowid > :after AND rowid <= :upto
+                        GROUP BY character_id, bucket
+                    ) g
+                    WHERE true
+                    ON CONFLICT(character_id, bucket) DO UPDATE SET
+                        min_value = MIN(COALESCE(min_value, excluded.min_value),
+                                        COALESCE(excluded.min_value, min_value)),
+                        max_value = MAX(COALESCE(max_value, excluded.max_value),
+                                        COALESCE(excluded.max_value, max_value)),
+                        sum_value = COALESCE(sum_value, 0) + excluded.sum_value,
+                        count = COALESCE(count, 0) + excluded.count,
+                        last_value = CASE WHEN last_at IS NULL OR excluded.last_at >= last_at
+                                          THEN excluded.last_value ELSE last_value END,
+                        last_at = MAX(COALESCE(last_at, excluded.last_at), excluded.last_at)
+                ''', params)
+        
+            cursor.execute('''
+                INSERT INTO rollup_state (name, watermark) VALUES ('mood_history', ?)
+                ON CONFLICT(name) DO UPDATE SET watermark = excluded.watermark
+            ''', (newest,))
+            
+            cursor.execute('COMMIT')
+            return newest
+        except BaseException:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    
+    def get_mood_series(self, character_id, start, end=None, max_points=200):
+        """
+        Ряд настроения персонажа для графика, не больше max_points точек.
+        Разрешение (raw / hour / day) выбирается по длине диапазона и бюджету точек;
+        если суток больше max_points, посуточные агрегаты группируются по bucket_days суток.
+        start, end - datetime или строки 'YYYY-MM-DD HH:MM:SS' (UTC).
+        Возвращает {'resolution': ..., 'bucket_days': ..., 'points': [{bucket, min, max, avg, last}, ...]}
+        """
+        start_dt = _parse_timestamp(start)
+        end_dt = _parse_timestamp(end) if end is not None else datetime.utcnow()
+        start_ts = start_dt.strftime('%Y-%m-%d %H:%M:%S')
+        end_ts = end_dt.strftime('%Y-%m-%d %H:%M:%S')
+        now = datetime.utcnow()
+        
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        
+        resolution = None
+        if start_dt >= now - timedelta(days=MOOD_RAW_RETENTION_DAYS):
+            # Считаем по индексу (character_id, created_at), но не дальше бюджета
+            cursor.execute('''
+                SELECT COUNT(*) FROM (
+                    SELECT 1 FROM mood_history
+                    WHERE character_id = ? AND created_at >= ? AND created_at <= ?
+                    LIMIT ?
+                )
+            ''', (character_id, start_ts, end_ts, max_points + 1))
+            if cursor.fetchone()[0] <= max_points:
+                resolution = 'raw'
+        if resolution is None:
+            span_hours = (end_dt - start_dt).total_seconds() / 3600
+            if (span_hours <= max_points
+                    and start_dt >= now - timedelta(days=MOOD_HOUR_RETENTION_DAYS)):
+                resolution = 'hour'
+            else:
+                resolution = 'day'
+        
+        bucket_days = None
+        if resolution == 'raw':
+            cursor.execute('''
+                SELECT created_at as bucket, mood_value as min, mood_value as max,
+                       mood_value as avg, mood_value as last
+                FROM mood_history
+                WHERE character_id = ? AND created_at >= ? AND created_at <= ?
+                ORDER BY created_at
+            ''', (character_id, start_ts, end_ts))
+            points = self._rows(cursor)
+        else:
+            # Агрегаты должны включать строки, пришедшие после последней свертки
+            self.compact_mood_history()
+            first_bucket = _bucket_start(start_ts, resolution)
+            if resolution == 'day':
+                span_days = (end_dt.date() - start_dt.date()).days + 1
+                bucket_days = max(1, -(-span_days // max_points))
+            if resolution == 'hour' or bucket_days == 1:
+                table = 'mood_rollup_hour' if resolution == 'hour' else 'mood_rollup_day'
+                cursor.execute(f'''
+                    SELECT bucket, min_value as min, max_value as max,
+                           sum_value / count as avg, last_value as last
+                    FROM {table}
+                    WHERE character_id = ? AND bucket >= ? AND bucket <= ?
+                    ORDER BY bucket
+                ''', (character_id, first_bucket, end_ts))
+                points = self._rows(cursor)
+            else:
+                # Группы по bucket_days суток от начала диапазона складываются
+                # в Python по суткам, которые уже идут в порядке первичного ключа
+                # (GROUP BY с оконной функцией строил три временных B-дерева).
+                # last - из последних суток группы
+                cursor.execute('''
+                    SELECT bucket, min_value, max_value, sum_value, count, last_value
+                    FROM mood_rollup_day
+                    WHERE character_id = ? AND bucket >= ? AND bucket <= ?
+                    ORDER BY bucket
+                ''', (character_id, first_bucket, end_ts))
+                first_day = _parse_timestamp(first_bucket).date()
+                groups = []
+                for bucket, low, high, total, count, last in cursor:
+                    group = (_parse_timestamp(bucket).date() - first_day).days // bucket_days
+                    if groups and groups[-1][0] == group:
+                        current = groups[-1]
+                        current[2] = min(current[2], low)
+                        current[3] = max(current[3], high)
+                        current[4] += total
+                        current[5] += count
+                        current[6] = last
+                    else:
+                        groups.append([group, bucket, low, high, total, count, last])
+                columns = ('bucket', 'min', 'max', 'avg', 'last')
+                rows = [(bucket, low, high, total / count, last)
+                        for _, bucket, low, high, total, count, last in groups]
+                if self.compact_rows:
+                    record = _record_type(columns)
+                    points = [record._make(row) for row in rows]
+                else:
+                    points = [dict(zip(columns, row)) for row in rows]
+        
+        conn.close()
+        return {'resolution': resolution, 'bucket_days': bucket_days, 'points': points}
+    
+    def iter_mood_history(self, character_id, start=None, end=None, batch_size=None):
+        """
+        Потоковая выгрузка сырой истории настроения персонажа в хронологическом порядке
+        """
+        return self._iter('''
+            SELECT mood_value, reason, created_at
+            FROM mood_history
+            WHERE character_id = ? AND created_at >= ? AND created_at <= ?
+            ORDER BY created_at
+        ''', (
+            character_id,
+            _parse_timestamp(start).strftime('%Y-%m-%d %H:%M:%S') if start is not None else '',
+            _parse_timestamp(end).strftime('%Y-%m-%d %H:%M:%S') if end is not None else '9999-12-31 23:59:59',
+        ), batch_size)
+    
+    def prune_mood_history(self, raw_days=MOOD_RAW_RETENTION_DAYS, hour_days=MOOD_HOUR_RETENTION_DAYS):
+        """
+        Удалить сырые строки mood_history старше raw_days и почасовые
+        агрегаты старше hour_days. Сначала выполняется свертка, и
+        несвернутые строки (rowid больше watermark) не удаляются никогда.
+        Возвращает (удалено сырых строк, удалено почасовых агрегатов).
+        """
+        watermark = self.compact_mood_history()
+        if not watermark:
+            return (0, 0)
+        
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            DELETE FROM mood_history
+            WHERE created_at < datetime('now', ?) AND rowid <= ?
+        ''', (f'-{int(raw_days)} days', watermark))
+        raw_deleted = cursor.rowcount
+        
+        cursor.execute('''
+            DELETE FROM mood_rollup_hour WHERE bucket < datetime('now', ?)
+        ''', (f'-{int(hour_days)} days',))
+        hour_deleted = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        return (raw_deleted, hour_deleted)
+    
     # ----- СТАТИСТИКА -----
     
     def get_room_stats(self):
@@ -552,18 +1414,28 @@ class VirtualWorldDB:
     
     # ----- СОБЫТИЯ МИРА -----
     
-    def set_world_state(self, key, value):
+    def set_world_state(self, key, value, mood_delta=None):
         """
-        Установить состояние мира (погода, время)
+        Установить состояние мира (погода, время).
+        mood_delta - сдвиг настроения всех онлайн персонажей
+        (применяется в той же транзакции)
         """
         conn = self._get_conn()
         cursor = conn.cursor()
         
+        # Upsert, а не INSERT OR REPLACE: в change_log изменение попадает как 'update'
         cursor.execute('''
-            INSERT OR REPLACE INTO world_state (key, value, updated_at)
+            INSERT INTO world_state (key, value, updated_at)
             VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET
+                value = excluded.value,
+                updated_at = excluded.updated_at
         ''', (key, value))
         
+        if mood_delta:
+            self._apply_mood_bulk(cursor, delta=mood_delta, status='online',
+                                  reason=f'{key}: {value}')
+        
         conn.commit()
         conn.close()
     
@@ -579,6 +1451,163 @@ class VirtualWorldDB:
         conn.close()
         
         return result[0] if result else None
+    
+    # ----- ЛЕНТА ИЗМЕНЕНИЙ -----
+    
+    def get_last_change_seq(self):
+        """
+        Текущий номер последнего изменения (0, если изменений не было)
+        """
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+        seq = cursor.fetchone()[0]
+        
+        conn.close()
+        return seq
+    
+    def get_changes(self, since_seq=0, limit=500):
+        """
+        Изменения после since_seq (не включительно), в порядке seq.
+        Для каждой записи в 'data' - текущее состояние строки
+        (None, если строка уже удалена); для 'mood_tick' - параметры тика.
+        Возвращает {'last_seq': ..., 'changes': [...], 'truncated': ...};
+        last_seq передать в следующий вызов. truncated=True - часть изменений
+        после since_seq уже удалена из журнала, состояние нужно перечитать.
+        """
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT MIN(seq) FROM change_log')
+        first_seq = cursor.fetchone()[0]
+        
+        cursor.execute('''
+            SELECT seq, table_name, op, row_key, created_at
+            FROM change_log
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+        ''', (since_seq, limit))
+        changes = [dict(row) for row in cursor.fetchall()]
+        
+        # Подтягиваем строки одним запросом на таблицу, а не по одной
+        keys_by_table = {}
+        for change in changes:
+            if change['op'] != 'mood_tick':
+                keys_by_table.setdefault(change['table_name'], set()).add(change['row_key'])
+        
+        rows_by_table = {}
+        for table_name, keys in keys_by_table.items():
+            keys = list(keys)
+            placeholders = ','.join('?' * len(keys))
+            if table_name == 'messages':
+                cursor.execute(f'''
+                    SELECT m.id, m.character_id, m.content, m.emotion_context,
+                           m.created_at, m.is_user, m.is_system, m.room_id,
+                           c.name as character_name, c.avatar_url
+                    FROM messages m
+                    LEFT JOIN characters c ON c.id = m.character_id
+                    WHERE m.id IN ({placeholders})
+                ''', keys)
+                key_column = 'id'
+            elif table_name == 'characters':
+                cursor.execute(f'''
+                    SELECT id, name, avatar_url, current_mood, mood_value,
+                           status, current_room, last_active
+                    FROM characters
+                    WHERE id IN ({placeholders})
+                ''', keys)
+                key_column = 'id'
+            else:
+                cursor.execute(f'''
+                    SELECT key, value, updated_at
+                    FROM world_state
+                    WHERE key IN ({placeholders})
+                ''', keys)
+                key_column = 'key'
+            rows_by_table[table_name] = {row[key_column]: dict(row) for row in cursor.fetchall()}
+        
+        conn.close()
+        
+        for change in changes:
+            if change['op'] == 'mood_tick':
+                change['data'] = json.loads(change['row_key'])
+            else:
+                change['data'] = rows_by_table[change['table_name']].get(change['row_key'])
+        
+        return {
+            'last_seq': changes[-1]['seq'] if changes else since_seq,
+            'changes': changes,
+            'truncated': first_seq is not None and first_seq > since_seq + 1
+        }
+    
+    def wait_for_changes(self, since_seq=0, timeout=30.0, poll_interval=0.2, limit=500):
+        """
+        Блокирующее ожидание изменений после since_seq.
+        Между опросами проверяется только PRAGMA data_version на одном
+        соединении, журнал читается лишь когда базу кто-то изменил.
+        По таймауту возвращает пустой список изменений.
+        """
+        deadline = time.monotonic() + timeout
+        conn = self._get_conn()
+        try:
+            version = None
+            while True:
+                current = conn.execute('PRAGMA data_version').fetchone()[0]
+                if current != version:
+                    version = current
+                    row = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()
+                    if row[0] > since_seq:
+                        break
+                if time.monotonic() >= deadline:
+                    return {'last_seq': since_seq, 'changes': [], 'truncated': False}
+                time.sleep(poll_interval)
+        finally:
+            conn.close()
+        
+        return self.get_changes(since_seq, limit)
+    
+    async def await_changes(self, since_seq=0, timeout=30.0, poll_interval=0.2, limit=500):
+        """
+        Асинхронный вариант wait_for_changes для asyncio-сервера.
+        Ожидающие не занимают потоки: PRAGMA data_version опрашивает один
+        общий поток (_ChangeWatcher) и будит их futures. Пул потоков нужен
+        только на чтение изменений, когда они уже есть.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        watcher = self._change_watcher(poll_interval)
+        watcher.add(since_seq, loop, future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return {'last_seq': since_seq, 'changes': [], 'truncated': False}
+        finally:
+            watcher.remove(future)
+        
+        return await asyncio.to_thread(self.get_changes, since_seq, limit)
+    
+    def _change_watcher(self, poll_interval):
+        """Общий опросчик ленты этого экземпляра (создается при первом ожидании)"""
+        with self._watcher_lock:
+            if self._watcher is None:
+                self._watcher = _ChangeWatcher(self._get_conn, poll_interval)
+            return self._watcher
+    
+    def trim_change_log(self, before_seq):
+        """
+        Удалить из журнала записи с seq < before_seq (уже доставленные всем подписчикам)
+        """
+        conn = self._get_conn()
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM change_log WHERE seq < ?', (before_seq,))
+        deleted = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        return deleted
 
 
 # =========================================
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Генератор синтетического мира для VirtualWorldDB.
+Создает воспроизводимую (по seed) базу заданного размера с реалистичным
+перекосом: немногие персонажи и комнаты дают большую часть активности.
+
+Пример:
+    python generate_world.py --preset large --db bench_world.db
+"""
+
+import argparse
+import bisect
+import functools
+import json
+import os
+import random
+import time
+
+from database import VirtualWorldDB, generate_id, init_database, get_connection
+
+# Готовые размеры мира
+PRESETS = {
+    'small': dict(characters=1_000, rooms=20, messages=50_000,
+                  relationships=5_000, mood_events=20_000),
+    'medium': dict(characters=10_000, rooms=100, messages=1_000_000,
+                   relationships=50_000, mood_events=200_000),
+    'large': dict(characters=100_000, rooms=500, messages=50_000_000,
+                  relationships=1_000_000, mood_events=5_000_000),
+}
+
+BATCH_SIZE = 50_000
+HISTORY_DAYS = 90
+# Конец истории по умолчанию (2026-01-01 00:00:00 UTC): фиксированный,
+# чтобы одинаковый seed давал одинаковую базу независимо от даты запуска
+DEFAULT_END = 1767225600
+ONLINE_SHARE = 0.2
+# Показатель степенного закона для активности персонажей и популярности комнат
+ZIPF_EXPONENT = 1.1
+
+WORDS = (
+    'привет как дела сегодня погода цветы идея проект кофе музыка книга '
+    'думаю согласен странно интересно давай позже вечером утром завтра '
+    'мир город комната друг новость код данные сон художник рецепт'
+).split()
+MOODS = ('happy', 'neutral', 'sad', 'excited', 'thoughtful', 'angry')
+RELATIONSHIP_TYPES = ('friend', 'best_friend', 'neutral', 'rival', 'colleague')
+
+
+def _zipf_sampler(rng, n, exponent=ZIPF_EXPONENT):
+    """Возвращает функцию, выбирающую индекс 0..n-1 по закону Ципфа"""
+    cumulative = []
+    total = 0.0
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** exponent
+        cumulative.append(total)
+
+    def sample():
+        return bisect.bisect_left(cumulative, rng.random() * total)
+    return sample
+
+
+def _timestamps(rng, count, start, end):
+    """Монотонные метки времени (секунды UTC) с небольшим дрожанием"""
+    step = (end - start) / max(1, count)
+    for i in range(count):
+        yield int(start + i * step + rng.random() * step)
+
+
+@functools.lru_cache(maxsize=1)
+def _format_ts(seconds):
+    """Секунды -> 'YYYY-MM-DD HH:MM:SS' (формат CURRENT_TIMESTAMP)"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+def _batched(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _character_id(index):
+    return f'{index:08d}-0000-4000-8000-000000000000'
+
+
+def _room_id(index):
+    return 'main-hall' if index == 0 else f'room-{index:04d}'
+
+
+def generate_world(db_name, characters, rooms, messages, relationships, mood_events,
+                   seed=42, days=HISTORY_DAYS, end=DEFAULT_END, verbose=True):
+    """
+    Создать (или перезаписать) базу db_name и заполнить ее синтетическими данными.
+    История занимает days суток до end (секунды UTC); при тех же seed и end
+    содержимое таблиц совпадает побайтно.
+    Возвращает словарь с фактическими количествами и временем загрузки.
+    """
+    if os.path.exists(db_name):
+        os.remove(db_name)
+    init_database(db_name)
+
+    rng = random.Random(seed)
+    pick_character = _zipf_sampler(rng, characters)
+    pick_room = _zipf_sampler(rng, rooms)
+    start = end - days * 86400
+
+    conn = get_connection(db_name)
+    conn.execute('PRAGMA foreign_keys = OFF')
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    cursor = conn.cursor()
+
+    # Триггеры ленты и вторичные индексы снимаем на время загрузки,
+    # init_database в конце вернет их на место
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_%_feed'")
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP TRIGGER {name}')
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'")
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP INDEX {name}')
+    conn.commit()
+
+    timings = {}
+
+    def load(table, sql, rows):
+        began = time.perf_counter()
+        count = 0
+        for batch in _batched(rows):
+            cursor.executemany(sql, batch)
+            conn.commit()
+            count += len(batch)
+        timings[table] = round(time.perf_counter() - began, 3)
+        if verbose:
+            print(f"   {table}: {count} строк за {timings[table]} с")
+        return count
+
+    # 1. Персонажи
+    character_rooms = [_room_id(pick_room()) for _ in range(characters)]
+
+    created_at = _format_ts(int(start))
+
+    def character_rows():
+        for i in range(characters):
+            mood_value = max(-1.0, min(1.0, rng.gauss(0.1, 0.4)))
+            yield (
+                _character_id(i), f'Персонаж {i}', f'/avatars/{i % 50}.png',
+                json.dumps({"openness": round(rng.random(), 2),
+                            "extraversion": round(rng.random(), 2)}),
+                ' '.join(rng.choices(WORDS, k=12)),
+                rng.choice(MOODS), mood_value,
+                'online' if rng.random() < ONLINE_SHARE else 'offline',
+                character_rooms[i], _format_ts(int(start + rng.random() * (end - start))),
+                created_at
+            )
+
+    load('characters', '''
+        INSERT INTO characters
+        (id, name, avatar_url, personality_traits, background_story, current_mood,
+         mood_value, status, current_room, last_active, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', character_rows())
+
+    # 2. Отношения (уникальные пары)
+    def relationship_rows():
+        seen = set()
+        target = min(relationships, characters * (characters - 1))
+        while len(seen) < target:
+            a = pick_character()
+            b = rng.randrange(characters)
+            if a == b or (a, b) in seen:
+                continue
+            seen.add((a, b))
+            moment = int(start + rng.random() * (end - start))
+            yield (
+                generate_id(moment * 1000, rng), _character_id(a), _character_id(b),
+                rng.choice(RELATIONSHIP_TYPES),
+                round(max(-1.0, min(1.0, rng.gauss(0.2, 0.5))), 3),
+                None, _format_ts(moment)
+            )
+
+    load('relationships', '''
+        INSERT INTO relationships
+        (id, character_id, related_character_id, relationship_type, strength,
+         memory_summary, last_interaction)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', relationship_rows())
+
+    # 3. Сообщения: болтливые персонажи, в основном в своей комнате
+    def message_rows():
+        for moment in _timestamps(rng, messages, start, end):
+            speaker = pick_character()
+            room = character_rooms[speaker] if rng.random() < 0.8 else _room_id(pick_room())
+            length = min(40, int(rng.expovariate(1 / 8)) + 1)
+            emotion = (json.dumps({"mood": rng.choice(MOODS), "intensity": round(rng.random(), 2)})
+                       if rng.random() < 0.3 else None)
+            yield (
+                generate_id(moment * 1000, rng), _character_id(speaker),
+                ' '.join(rng.choices(WORDS, k=length)), emotion,
+                1 if rng.random() < 0.05 else 0, 0, room, _format_ts(moment)
+            )
+
+    load('messages', '''
+        INSERT INTO messages
+        (id, character_id, content, emotion_context, is_user, is_system, room_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', message_rows())
+
+    # 4. История настроения
+    def mood_rows():
+        for moment in _timestamps(rng, mood_events, start, end):
+            yield (
+                _character_id(pick_character()),
+                round(max(-1.0, min(1.0, rng.gauss(0.1, 0.4))), 3),
+                rng.choice(WORDS), _format_ts(moment)
+            )
+
+    load('mood_history', '''
+        INSERT INTO mood_history (character_id, mood_value, reason, created_at)
+        VALUES (?, ?, ?, ?)
+    ''', mood_rows())
+
+    cursor.execute('''
+        INSERT OR REPLACE INTO world_state (key, value, updated_at)
+        VALUES ('weather', 'sunny', :at), ('time_of_day', 'day', :at)
+    ''', {'at': _format_ts(int(end))})
+    conn.commit()
+    conn.close()
+
+    # Индексы, триггеры и агрегаты - после загрузки, одним проходом
+    began = time.perf_counter()
+    init_database(db_name)
+    # Как в рабочей базе: сырые строки уже свернуты в агрегаты
+    VirtualWorldDB(db_name).compact_mood_history()
+    conn = get_connection(db_name)
+    conn.execute('ANALYZE')
+    conn.close()
+    timings['indexes'] = round(time.perf_counter() - began, 3)
+
+    return {
+        'db_name': db_name,
+        'seed': seed,
+        'end': end,
+        'counts': dict(characters=characters, rooms=rooms, messages=messages,
+                       relationships=relationships, mood_events=mood_events),
+        'timings': timings,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Генератор синтетического мира')
+    parser.add_argument('--db', default='bench_world.db')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--days', type=int, default=HISTORY_DAYS)
+    parser.add_argument('--end', type=int, default=DEFAULT_END,
+                        help='конец истории, секунды UTC')
+    for name in PRESETS['small']:
+        parser.add_argument(f'--{name.replace("_", "-")}', type=int, dest=name)
+    args = parser.parse_args()
+
+    counts = dict(PRESETS[args.preset])
+    for name in counts:
+        if getattr(args, name) is not None:
+            counts[name] = getattr(args, name)
+
+    print(f"Генерация мира {counts} -> {args.db}")
+    result = generate_world(args.db, seed=args.seed, days=args.days, end=args.end, **counts)
+    print(f"✅ Готово: {json.dumps(result['timings'], ensure_ascii=False)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Проверка планов запросов VirtualWorldDB.
+Каждый публичный метод вызывается на небольшом синтетическом мире
+(с ANALYZE-статистикой), все выполненные им SQL-выражения перехватываются
+и прогоняются через EXPLAIN QUERY PLAN. Ветки SQL, которые не проходят
+сценарии бенчмарка, вызываются отдельно (branch_cases). Полный SCAN или
+временное B-дерево, не внесенные в PLAN_ALLOWLIST для этого выражения
+и этого шага плана, считаются регрессией.
+
+Пример:
+    python query_plans.py            # отчет + код выхода 1 при регрессиях
+    python query_plans.py --json     # отчет в JSON
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from database import VirtualWorldDB
+from benchmark_db import build_cases, _drain
+from generate_world import DEFAULT_END, generate_world, _character_id
+
+# Небольшой мир: важны схема и статистика планировщика, а не объем
+PLAN_WORLD = dict(characters=500, rooms=10, messages=5_000,
+                  relationships=2_000, mood_events=2_000)
+
+# Осознанно допустимые шаги плана. Ключ - регулярное выражение, узнающее
+# одно SQL-выражение (ищется в нормализованном тексте: пробелы схлопнуты,
+# литералы заменены на ?), значение - точные шаги плана с предками через ' > '.
+# Разрешение не переносится ни на другие выражения, ни на другие шаги того же
+# выражения. Каждый пункт должен объяснять, почему шаг не O(n) или почему O(n)
+# здесь неизбежен.
+PLAN_ALLOWLIST = {
+    # Ростер одной комнаты (онлайн-персонажи) мал; last_active не входит в индекс,
+    # потому что его переписывает каждый тик настроения
+    r'WHERE status = \? AND current_room = \? ORDER BY last_active DESC$': (
+        'USE TEMP B-TREE FOR ORDER BY',
+    ),
+    # Хронологический порядок 20 последних сообщений комнаты (внешний запрос над LIMIT)
+    r'WHERE m\.room_id = \? ORDER BY m\.created_at DESC LIMIT \? \) ORDER BY created_at$': (
+        'USE TEMP B-TREE FOR ORDER BY',
+    ),
+    # Обход idx_messages_created по порядку, LIMIT останавливает его на первых строках;
+    # внешняя сортировка переупорядочивает только эти limit строк
+    r'ON c\.id = m\.character_id ORDER BY m\.created_at DESC LIMIT \? \) ORDER BY created_at$': (
+        'CO-ROUTINE (subquery-1) > SCAN m USING INDEX idx_messages_created',
+        'USE TEMP B-TREE FOR ORDER BY',
+    ),
+    r'WHERE m\.created_at < \? ORDER BY m\.created_at DESC LIMIT \? \) ORDER BY created_at$': (
+        'USE TEMP B-TREE FOR ORDER BY',
+    ),
+    # Экспорт всей истории без фильтра - проход по индексу времени без сортировки
+    r'LEFT JOIN characters c ON c\.id = m\.character_id ORDER BY m\.created_at$': (
+        'SCAN m USING INDEX idx_messages_created',
+    ),
+    # LIKE '%...%' не использует B-дерево; нужен будет полнотекстовый индекс
+    r'WHERE name LIKE \? OR background_story LIKE \?': (
+        'SCAN characters',
+    ),
+    # Общие счетчики - по определению проход по покрывающему индексу
+    r'^SELECT \(SELECT COUNT\(\*\) FROM characters\) as total_characters': (
+        'SCALAR SUBQUERY 1 > SCAN characters USING COVERING INDEX idx_characters_room',
+        'SCALAR SUBQUERY 3 > SCAN messages USING COVERING INDEX idx_messages_created',
+    ),
+    # Тик настроения сортирует по id только затронутых персонажей (их строки и так пишутся),
+    # чтобы вставки в idx_mood_character шли по порядку
+    r'FROM characters WHERE status = \? AND current_room = \? ORDER BY id$': (
+        'USE TEMP B-TREE FOR ORDER BY',
+    ),
+    r'FROM characters WHERE current_room = \? ORDER BY id$': (
+        'USE TEMP B-TREE FOR ORDER BY',
+    ),
+    # Тик по статусу затрагивает большую долю персонажей (все онлайн):
+    # планировщик предпочитает упорядоченный проход по ключу сортировке
+    r'FROM characters WHERE status = \? ORDER BY id$': (
+        'SCAN characters USING INDEX sqlite_autoindex_characters_1',
+    ),
+    # Тик без фильтров меняет всех персонажей - O(n) по определению
+    r'^UPDATE characters SET mood_value = .* last_active = CURRENT_TIMESTAMP$': (
+        'SCAN characters',
+    ),
+    r'FROM characters ORDER BY id$': (
+        'SCAN characters USING INDEX sqlite_autoindex_characters_1',
+    ),
+    # Свертка группирует только новые строки (после watermark)
+    r'^INSERT INTO mood_rollup_(hour|day) ': (
+        'CO-ROUTINE g > USE TEMP B-TREE FOR GROUP BY',
+    ),
+}
+
+# Строки плана, которые считаются регрессией
+BAD_PLAN_PATTERNS = (
+    re.compile(r'^SCAN (?!CONSTANT ROW)'),
+    re.compile(r'USE TEMP B-TREE'),
+)
+INDEX_PATTERN = re.compile(r'USING (?:COVERING )?INDEX (\w+)|USING (INTEGER PRIMARY KEY)')
+SUBQUERY_PATTERN = re.compile(r'^(?:CO-ROUTINE|MATERIALIZE) (.+)$')
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b-?\d+(?:\.\d+)?\b|X'[0-9A-Fa-f]*'")
+# Служебные выражения, у которых нет плана
+SKIP_PATTERN = re.compile(r'^\s*(--|PRAGMA|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|ANALYZE)', re.IGNORECASE)
+
+
+class PlanRecordingDB(VirtualWorldDB):
+    """VirtualWorldDB, запоминающий все SQL-выражения, выполненные каждым методом"""
+
+    def __init__(self, db_name):
+        super().__init__(db_name)
+        self.current_method = None
+        self.statements = {}
+
+    def _get_conn(self):
+        conn = super()._get_conn()
+        conn.set_trace_callback(self._record)
+        return conn
+
+    def _record(self, sql):
+        if self.current_method is None or SKIP_PATTERN.match(sql):
+            return
+        # Трассировка отдает SQL с подставленными значениями; для группировки
+        # литералы заменяются на ?, а на EXPLAIN уходит первый реальный вариант
+        normalized = ' '.join(sql.split())
+        key = LITERAL_PATTERN.sub('?', normalized)
+        bucket = self.statements.setdefault(self.current_method, {})
+        bucket.setdefault(key, normalized)
+
+
+def explain(conn, sql):
+    """Строки EXPLAIN QUERY PLAN (id, parent, detail) для выражения с подставленными значениями"""
+    return [(row[0], row[1], row[3]) for row in conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()]
+
+
+def plan_paths(plan):
+    """Шаги плана вместе с предками: 'CO-ROUTINE (subquery-1) > SCAN m'"""
+    paths = {}
+    result = []
+    for node_id, parent, detail in plan:
+        path = f'{paths[parent]} > {detail}' if parent in paths else detail
+        paths[node_id] = path
+        result.append(path)
+    return result
+
+
+def find_violations(plan, allowed=()):
+    """
+    Шаги плана (пути от корня) с полным SCAN или временным B-деревом,
+    кроме путей из allowed. SCAN по подзапросу (CO-ROUTINE / MATERIALIZE)
+    регрессией не считается - он ограничен самим подзапросом.
+    """
+    subqueries = set()
+    for _, _, detail in plan:
+        match = SUBQUERY_PATTERN.match(detail)
+        if match:
+            subqueries.add(f'SCAN {match.group(1)}')
+
+    bad = []
+    for (_, _, detail), path in zip(plan, plan_paths(plan)):
+        if not any(p.search(detail) for p in BAD_PLAN_PATTERNS):
+            continue
+        if detail in subqueries or path in allowed:
+            continue
+        bad.append(path)
+    return bad
+
+
+def allowed_steps(sql_key):
+    """Разрешенные пути плана для выражения и ключи PLAN_ALLOWLIST, которые к нему относятся"""
+    keys = [key for key in PLAN_ALLOWLIST if re.search(key, sql_key)]
+    return {path for key in keys for path in PLAN_ALLOWLIST[key]}, keys
+
+
+def branch_cases(db):
+    """
+    Сценарии для веток SQL, которые не проходит build_cases (один вызов -
+    один вариант выражения): (метод, функция без аргументов).
+    """
+    hot = _character_id(0)
+    now = datetime.utcnow()
+    world_end = datetime.utcfromtimestamp(DEFAULT_END)
+    since = (world_end - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+    return [
+        ('get_chat_history', lambda: db.get_chat_history(limit=50, before=since)),
+        ('iter_chat_history', lambda: _drain(db.iter_chat_history())),
+        ('iter_chat_history', lambda: _drain(db.iter_chat_history(since=since))),
+        ('iter_chat_history', lambda: _drain(db.iter_chat_history(room_id='main-hall', since=since))),
+        ('update_mood_bulk', lambda: db.update_mood_bulk(delta=0.01, status='online')),
+        ('update_mood_bulk', lambda: db.update_mood_bulk(target=0.0, room_id='main-hall')),
+        ('update_mood_bulk', lambda: db.update_mood_bulk(delta=0.01)),
+        # Разрешение ряда выбирается от текущего времени: raw - последний час,
+        # hour - 5 суток в пределах MOOD_HOUR_RETENTION_DAYS, day - 60 суток
+        # давностью больше года, группы суток - диапазон длиннее max_points суток
+        ('get_mood_series', lambda: db.get_mood_series(hot, now - timedelta(hours=1), now)),
+        ('get_mood_series', lambda: db.get_mood_series(
+            hot, now - timedelta(days=40), now - timedelta(days=35))),
+        ('get_mood_series', lambda: db.get_mood_series(
+            hot, now - timedelta(days=400), now - timedelta(days=340))),
+        ('get_mood_series', lambda: db.get_mood_series(hot, now - timedelta(days=400), now)),
+        ('set_world_state', lambda: db.set_world_state('weather', 'storm', mood_delta=-0.05)),
+        # Все три таблицы ленты: сообщения, персонажи, состояние мира
+        ('get_changes', lambda: db.get_changes(0, limit=1000)),
+    ]
+
+
+def check_query_plans(db_name=None):
+    """
+    Собрать планы всех запросов и найти регрессии.
+    Сценарии меняют данные (сообщения, настроение, очистка истории), поэтому
+    готовая база db_name не трогается: проверка идет на ее временной копии.
+    Возвращает {'statements': [...], 'violations': [...]}.
+    """
+    handle, work_db = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    try:
+        if db_name is None:
+            # init_database печатает в stdout - уводим, чтобы не ломать --json
+            with contextlib.redirect_stdout(sys.stderr):
+                generate_world(work_db, verbose=False, **PLAN_WORLD)
+        else:
+            source = sqlite3.connect(f'file:{db_name}?mode=ro', uri=True)
+            target = sqlite3.connect(work_db)
+            source.backup(target)
+            target.close()
+            source.close()
+
+        db = PlanRecordingDB(work_db)
+        cases = [(name, functools.partial(case, 0))
+                 for name, case in build_cases(db, PLAN_WORLD).items()]
+        for name, case in cases + branch_cases(db):
+            db.current_method = name
+            case()
+        db.current_method = None
+
+        conn = db._get_conn()
+        conn.set_trace_callback(None)
+        report = []
+        violations = []
+        used = set()
+        for method, statements in db.statements.items():
+            for key, sql in statements.items():
+                plan = explain(conn, sql)
+                paths = plan_paths(plan)
+                details = [detail for _, _, detail in plan]
+                indexes = sorted({a or b for a, b in INDEX_PATTERN.findall('\n'.join(details))})
+                allowed, keys = allowed_steps(key)
+                used.update((k, path) for k in keys for path in PLAN_ALLOWLIST[k] if path in paths)
+                bad = find_violations(plan, allowed)
+                entry = {'method': method, 'sql': sql, 'plan': paths,
+                         'indexes': indexes, 'violations': bad}
+                report.append(entry)
+                if bad:
+                    violations.append(entry)
+        conn.close()
+    finally:
+        os.remove(work_db)
+
+    # Разрешения, которым не нашлось шага плана: устарели или фрагмент SQL не совпал
+    unused = [{'sql': k, 'step': path}
+              for k, paths in PLAN_ALLOWLIST.items() for path in paths
+              if (k, path) not in used]
+    return {'statements': report, 'violations': violations, 'unused_allowlist': unused}
+
+
+def format_report(result):
+    lines = []
+    for entry in result['statements']:
+        mark = '❌' if entry['violations'] else '✅'
+        sql = entry['sql'] if len(entry['sql']) <= 90 else entry['sql'][:87] + '...'
+        lines.append(f"{mark} {entry['method']}: {', '.join(entry['indexes']) or '-'}")
+        lines.append(f"     {sql}")
+        for step in entry['violations']:
+            lines.append(f"     ⚠️  {step}")
+    for item in result['unused_allowlist']:
+        lines.append(f"⚠️  не использовано разрешение: {item['step']}")
+        lines.append(f"     /{item['sql']}/")
+    lines.append('')
+    lines.append(f"Запросов: {len(result['statements'])}, регрессий: {len(result['violations'])}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка планов запросов VirtualWorldDB')
+    parser.add_argument('--db', help='готовая база; проверяется ее временная копия '
+                             '(по умолчанию - синтетический мир)')
+    parser.add_argument('--json', action='store_true', help='вывести отчет в JSON')
+    args = parser.parse_args()
+
+    result = check_query_plans(args.db)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(result))
+    sys.exit(1 if result['violations'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Агрегаты mood_rollup_hour / mood_rollup_day должны совпадать с прямым
+GROUP BY по сырым строкам mood_history при любом порядке сверток.
+"""
+
+import os
+import random
+import sys
+import threading
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import VirtualWorldDB, get_connection, init_database
+
+CHARACTERS = ['a', 'b', 'c']
+
+
+def _make_db(tmp_path):
+    db_name = str(tmp_path / 'world.db')
+    init_database(db_name)
+    conn = get_connection(db_name)
+    conn.executemany('INSERT INTO characters (id, name) VALUES (?, ?)',
+                     [(c, c.upper()) for c in CHARACTERS])
+    conn.commit()
+    conn.close()
+    return db_name
+
+
+def _insert_raw(db_name, rows):
+    conn = get_connection(db_name)
+    conn.executemany('''
+        INSERT INTO mood_history (character_id, mood_value, reason, created_at)
+        VALUES (?, ?, NULL, ?)
+    ''', rows)
+    conn.commit()
+    conn.close()
+
+
+def _random_rows(rng, count, end, days):
+    rows = []
+    for _ in range(count):
+        moment = end - timedelta(seconds=rng.randrange(days * 86400))
+        rows.append((rng.choice(CHARACTERS), round(rng.uniform(-1, 1), 3),
+                     moment.strftime('%Y-%m-%d %H:%M:%S')))
+    return rows
+
+
+def _assert_rollups_match(db_name):
+    conn = get_connection(db_name)
+    for table, bucket_sql in (
+        ('mood_rollup_hour', "strftime('%Y-%m-%d %H:00:00', created_at)"),
+        ('mood_rollup_day', "date(created_at) || ' 00:00:00'"),
+    ):
+        expected = conn.execute(f'''
+            SELECT character_id, {bucket_sql} as bucket, MIN(mood_value), MAX(mood_value),
+                   ROUND(TOTAL(mood_value), 6), COUNT(mood_value)
+            FROM mood_history
+            GROUP BY character_id, bucket
+            ORDER BY character_id, bucket
+        ''').fetchall()
+        actual = conn.execute(f'''
+            SELECT character_id, bucket, min_value, max_value, ROUND(sum_value, 6), count
+            FROM {table}
+            ORDER BY character_id, bucket
+        ''').fetchall()
+        assert [tuple(r) for r in actual] == [tuple(r) for r in expected], table
+    conn.close()
+
+
+def test_repeated_compaction_matches_group_by(tmp_path):
+    db_name = _make_db(tmp_path)
+    db = VirtualWorldDB(db_name)
+    rng = random.Random(1)
+    end = datetime(2026, 1, 10)
+
+    _insert_raw(db_name, _random_rows(rng, 500, end, days=5))
+    db.compact_mood_history()
+    db.compact_mood_history()
+
+    # Строки той же секунды, что и последняя свернутая, и задним числом
+    same_second = end.strftime('%Y-%m-%d %H:%M:%S')
+    _insert_raw(db_name, [('a', 0.5, same_second), ('a', -0.5, same_second)])
+    _insert_raw(db_name, _random_rows(rng, 200, end - timedelta(days=30), days=3))
+    db.compact_mood_history()
+
+    _assert_rollups_match(db_name)
+
+
+def test_concurrent_compaction_matches_group_by(tmp_path):
+    db_name = _make_db(tmp_path)
+    rng = random.Random(2)
+    end = datetime(2026, 1, 10)
+    _insert_raw(db_name, _random_rows(rng, 5_000, end, days=10))
+
+    errors = []
+
+    def compact():
+        try:
+            for _ in range(5):
+                VirtualWorldDB(db_name).compact_mood_history()
+        except Exception as e:  # pragma: no cover - сообщение в assert ниже
+            errors.append(e)
+
+    def write():
+        for _ in range(5):
+            _insert_raw(db_name, _random_rows(rng, 200, end, days=10))
+
+    threads = [threading.Thread(target=compact) for _ in range(4)]
+    threads.append(threading.Thread(target=write))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+    VirtualWorldDB(db_name).compact_mood_history()
+    _assert_rollups_match(db_name)